@@ -17,16 +17,19 @@
 
 import argparse
 import logging
+import multiprocessing as mp
+import os
 import sys
 import traceback
 
 from metatree import __description__, __version__
-from metatree.common import check_on_path
+from metatree.common import check_on_path, make_sure_path_exists
 from metatree.exception import MetaTreeException, MetaTreeExit
 from metatree.io import Batchfile
 from metatree.io.taxonomy_file import TaxonomyFile
 from metatree.logger import logger_setup
 from metatree.pipeline import run_pipeline
+from metatree.tree_metrics import METRICS
 
 
 def print_help():
@@ -43,6 +46,39 @@ def main(args=None):
     parser.add_argument('taxonomy_file', type=str, help='path to taxonomy file, format: gid<tab>taxonomy')
     parser.add_argument('outgroup', type=str, help='outgroup for rooting')
     parser.add_argument('cpus', type=int, help='number of CPUs to use')
+    parser.add_argument('--rf_method', type=str, default='pairwise',
+                        choices=('pairwise', 'cached', 'matrix', 'fingerprint'),
+                        help='pairwise: re-read both trees for each comparison, '
+                             'cached: read and encode each tree once (faster, uses more memory), '
+                             'matrix: as cached, but compare all trees in a single step, '
+                             'fingerprint: as matrix, but store each split as a 128-bit fingerprint '
+                             '(memory is linear in the number of taxa, use for very large trees) '
+                             '(only used if rf is the only metric)')
+    parser.add_argument('--metrics', type=str, nargs='+', default=['rf'], choices=tuple(METRICS),
+                        help='distance metric(s) to calculate between each pair of trees, if any other than '
+                             'rf are given, all are calculated together from a single encoding of each tree')
+    parser.add_argument('--min_support', type=float, default=50.0,
+                        help='minimum support value of a split to be considered well-supported (supported_splits)')
+    parser.add_argument('--max_depth', type=float, default=1.0,
+                        help='maximum relative depth of a split to be considered well-supported (supported_splits)')
+    parser.add_argument('--root_engine', type=str, default='native', choices=('native', 'genometreetk'),
+                        help='native: root trees in-process, genometreetk: run genometreetk outgroup for each tree')
+    parser.add_argument('--decorate_engine', type=str, default='native', choices=('native', 'phylorank'),
+                        help='native: decorate trees in-process (as phylorank decorate --skip_rd_refine), '
+                             'phylorank: run phylorank decorate for each tree')
+    parser.add_argument('--formats', type=str, nargs='+', default=['svg'], choices=('svg', 'pdf', 'png'),
+                        help='output format(s) of the tree comparison')
+    parser.add_argument('--annot_max', type=int, default=50,
+                        help='only annotate the values in the heatmaps if there are at most this many trees')
+    parser.add_argument('--trace', action='store_true', default=False,
+                        help='also write the timing of each stage and task as a Chrome trace (run_trace.json)')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='store rooted and decorated trees in this directory to be re-used between runs')
+    parser.add_argument('--cache_size', type=float, default=None,
+                        help='maximum size of the cache directory (GB), least recently used trees are removed')
+    parser.add_argument('--start_method', type=str, default=None, choices=mp.get_all_start_methods(),
+                        help='how the worker processes are started (default: the platform default), '
+                             'a single pool of workers is used for every stage')
 
     # Verify that a subparser was selected
     if len(sys.argv) == 1:
@@ -64,17 +100,27 @@ def main(args=None):
         try:
             # Validate the input arguments.
             batchfile = Batchfile(args.batchfile)
-            tax_file = TaxonomyFile(args.taxonomy_file)
+            dir_intermediate = os.path.join(args.out_dir, 'intermediate_results')
+            make_sure_path_exists(dir_intermediate)
+            tax_file = TaxonomyFile(args.taxonomy_file, os.path.join(dir_intermediate, 'taxonomy.idx'))
             if not args.outgroup or args.outgroup[0:3] not in {'d__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__'}:
                 raise MetaTreeExit(f'Invalid outgroup: {args.outgroup}')
             cpus = max(1, args.cpus)
 
             # Assert that the required programs are on the system path.
-            for prog in ('genometreetk', 'phylorank'):
+            required = list()
+            if args.root_engine == 'genometreetk':
+                required.append('genometreetk')
+            if args.decorate_engine == 'phylorank':
+                required.append('phylorank')
+            for prog in required:
                 check_on_path(prog)
 
             # Run the pipeline.
-            run_pipeline(batchfile, args.out_dir, tax_file, args.outgroup, cpus)
+            run_pipeline(batchfile, args.out_dir, tax_file, args.outgroup, cpus, args.rf_method,
+                         args.root_engine, args.decorate_engine, args.cache_dir, args.cache_size,
+                         args.formats, args.annot_max, args.trace, tuple(dict.fromkeys(args.metrics)),
+                         args.min_support, args.max_depth, args.start_method)
 
         except SystemExit:
             sys.stdout.write('\n')
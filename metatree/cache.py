@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from metatree import __version__
+from metatree.common import make_sure_path_exists
+
+
+class ArtifactCache(object):
+    """Content-addressed store of intermediate files (e.g. rooted trees).
+
+    Each output is stamped with the key of the inputs which created it, so
+    that it is only reused if the inputs are unchanged. If a cache directory
+    is given, outputs are also stored there and shared between runs. The
+    least recently used entries are removed once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        self.logger = logging.getLogger('timestamp')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file_hashes = dict()
+        if path:
+            make_sure_path_exists(path)
+
+    def hash_file(self, path):
+        """Return the SHA256 of a file's content, this is only calculated once per path."""
+        if path not in self.file_hashes:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b''):
+                    sha.update(chunk)
+            self.file_hashes[path] = sha.hexdigest()
+        return self.file_hashes[path]
+
+    @staticmethod
+    def make_key(*parts):
+        """Create a key from the inputs (and the version of metatree)."""
+        sha = hashlib.sha256()
+        for part in (__version__,) + parts:
+            sha.update(str(part).encode())
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[0:2], key)
+
+    @staticmethod
+    def _stamp(path):
+        return f'{path}.key'
+
+    @staticmethod
+    def _copy(path_from, path_to):
+        """Atomically copy a file."""
+        path_tmp = f'{path_to}.tmp'
+        shutil.copyfile(path_from, path_tmp)
+        os.replace(path_tmp, path_to)
+
+    def fetch(self, key, paths):
+        """Ensure that paths were created from key, returns False if they need to be created.
+
+        The first path is used as the stamp for all paths, entries in the
+        cache are named by their position in paths.
+        """
+        stamp = self._stamp(paths[0])
+        if all(os.path.isfile(x) for x in paths) and os.path.isfile(stamp):
+            with open(stamp) as fh:
+                if fh.read().strip() == key:
+                    return True
+
+        # The existing outputs (if any) are stale.
+        if os.path.isfile(stamp):
+            os.remove(stamp)
+
+        if not self.path:
+            return False
+        entry = self._entry(key)
+        cached = [os.path.join(entry, str(i)) for i in range(len(paths))]
+        if not all(os.path.isfile(x) for x in cached):
+            return False
+
+        for path_from, path_to in zip(cached, paths):
+            make_sure_path_exists(os.path.dirname(path_to))
+            self._copy(path_from, path_to)
+        os.utime(entry)
+        with open(stamp, 'w') as fh:
+            fh.write(f'{key}\n')
+        return True
+
+    def store(self, key, paths):
+        """Stamp the paths which were created from key, and add them to the cache."""
+        with open(self._stamp(paths[0]), 'w') as fh:
+            fh.write(f'{key}\n')
+        if not self.path:
+            return
+
+        # Create the entry in a temporary directory, then move it into place.
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            make_sure_path_exists(os.path.dirname(entry))
+            dir_tmp = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix='.tmp_')
+            for i, path in enumerate(paths):
+                shutil.copyfile(path, os.path.join(dir_tmp, str(i)))
+            try:
+                os.rename(dir_tmp, entry)
+            except OSError:
+                # Created concurrently by another process.
+                shutil.rmtree(dir_tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within max_bytes."""
+        if not self.path or self.max_bytes is None:
+            return
+
+        entries = list()
+        total = 0
+        for prefix in os.listdir(self.path):
+            dir_prefix = os.path.join(self.path, prefix)
+            if not os.path.isdir(dir_prefix):
+                continue
+            for key in os.listdir(dir_prefix):
+                if key.startswith('.tmp_'):
+                    continue
+                entry = os.path.join(dir_prefix, key)
+                size = sum(os.path.getsize(os.path.join(entry, x)) for x in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+                total += size
+
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
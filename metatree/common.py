@@ -1,6 +1,8 @@
 import logging
+import multiprocessing as mp
 import os
 import sys
+from contextlib import contextmanager
 
 
 def make_sure_path_exists(path):
@@ -124,3 +126,28 @@ def rgba_hex(r, g, b, a=1):
 def hex_rgb(v):
     h = v.lstrip('#')
     return tuple(int(h[i:i + 2], 16) for i in (0, 2, 4))
+
+
+@contextmanager
+def worker_pool(cpus, pool=None, start_method=None, initializer=None, initargs=()):
+    """Yield pool if one is given, otherwise create a pool which is closed on exit.
+
+    A given pool is left open so it can be re-used, and must have already
+    been created with any initializer required by its tasks.
+
+    Parameters
+    ----------
+    cpus : int
+        The number of processes in a new pool.
+    pool : multiprocessing.pool.Pool
+        An existing pool to use.
+    start_method : str
+        The start method of a new pool (fork, spawn, or forkserver), the
+        platform default is used if None.
+    """
+    if pool is not None:
+        yield pool
+    else:
+        with mp.get_context(start_method).Pool(processes=cpus, initializer=initializer,
+                                               initargs=initargs) as new_pool:
+            yield new_pool
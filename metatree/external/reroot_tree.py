@@ -0,0 +1,147 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+__author__ = 'Donovan Parks'
+__copyright__ = 'Copyright 2017'
+__credits__ = ['Donovan Parks']
+__license__ = 'GPL3'
+__version__ = '0.0.1'
+__maintainer__ = 'Donovan Parks'
+__email__ = 'donovan.parks@gmail.com'
+__status__ = 'Development'
+
+import logging
+
+import dendropy
+from biolib.newick import parse_label, create_label
+
+from metatree.exception import MetaTreeExit
+
+
+class RerootTree(object):
+    """Reroot tree, adapted from GenomeTreeTk to run in-process."""
+
+    def __init__(self):
+        """Initialization."""
+
+        self.logger = logging.getLogger('timestamp')
+
+    def _reroot(self, tree, outgroup_node, max_support=100):
+        """Reroot tree taking proper care of bootstrap values."""
+
+        # determine support values for each bipartition
+        tree.encode_bipartitions()
+        support_values = {}
+        for nd in tree:
+            support, taxon, aux_info = parse_label(nd.label)
+            if nd.is_leaf():
+                support_values[nd.bipartition] = max_support
+            else:
+                if support is not None:
+                    support_values[nd.bipartition] = float(support)
+                else:
+                    support_values[nd.bipartition] = None
+
+        # move support values for desired re-rooting
+        new_root = outgroup_node.parent_node
+        tree.reseed_at(new_root)
+        tree.encode_bipartitions()
+        for nd in tree:
+            _, taxon, aux_info = parse_label(nd.label)
+            nd.label = create_label(support_values.get(nd.bipartition, "not_specified"), taxon, aux_info)
+        tree.seed_node.edge.length = None
+
+        # do a hard re-rooting of the tree
+        # (this invalidates the previous bipartitions, so must be done seperately)
+        tree.is_rooted = True
+        half_length = None if outgroup_node.edge_length is None else 0.5 * outgroup_node.edge_length
+        tree.reroot_at_edge(outgroup_node.edge, length1=half_length, length2=half_length)
+
+        # determine bootstrap for new node
+        for child in tree.seed_node.child_node_iter():
+            if outgroup_node.is_leaf():
+                if not child.is_leaf():
+                    support, taxon, aux_info = parse_label(child.label)
+                    child.label = create_label(max_support, taxon, aux_info)
+            else:
+                if child != outgroup_node:
+                    support, _taxon, _aux_info = parse_label(outgroup_node.label)
+                    _support, taxon, aux_info = parse_label(child.label)
+                    child.label = create_label(support, taxon, aux_info)
+
+        return tree
+
+    def root_with_outgroup(self, input_tree, output_tree, outgroup):
+        """Reroot the tree using the given outgroup.
+
+        Parameters
+        ----------
+        input_tree : str
+          File containing Newick tree to rerooted.
+        output_tree : str
+          Name of file for rerooted tree.
+        outgroup : iterable
+          Labels of taxa in outgroup.
+        """
+
+        outgroup_in_tree = set()
+        tree = dendropy.Tree.get_from_path(input_tree,
+                                           schema='newick',
+                                           rooting='force-unrooted',
+                                           preserve_underscores=True)
+
+        outgroup = set(outgroup)
+        for n in tree.leaf_node_iter():
+            if n.taxon.label in outgroup:
+                outgroup_in_tree.add(n.taxon)
+
+        if len(outgroup_in_tree) == 0:
+            raise MetaTreeExit(f'No outgroup taxa identified in the tree, tree was not rerooted: {input_tree}')
+
+        # The basal node of the Newick may fall between outgroup taxa, in which
+        # case their MRCA would be the seed node. As in GenomeTreeTk, the MRCA is
+        # taken once (a copy of) the tree has been rooted on an ingroup leaf.
+        ingroup_leaf = next((n for n in tree.leaf_node_iter() if n.taxon not in outgroup_in_tree), None)
+        if ingroup_leaf is None:
+            raise MetaTreeExit(f'All taxa in the tree are in the outgroup, tree was not rerooted: {input_tree}')
+        tree_ingroup = dendropy.Tree(tree)
+        tree_ingroup.reroot_at_edge(tree_ingroup.find_node_with_taxon_label(ingroup_leaf.taxon.label).edge)
+        mrca = tree_ingroup.mrca(taxon_labels=[x.label for x in outgroup_in_tree])
+        n_mrca = len(mrca.leaf_nodes())
+        if n_mrca == len(tree_ingroup.leaf_nodes()):
+            raise MetaTreeExit(f'The MRCA of the outgroup spans all taxa in the tree, the outgroup is likely '
+                               f'polyphyletic and not suitable for rooting: {input_tree}')
+        if n_mrca != len(outgroup_in_tree):
+            self.logger.warning(f'The outgroup is not monophyletic ({len(outgroup_in_tree):,} taxa, while their '
+                                f'MRCA has {n_mrca:,} leaf nodes), the tree will be rerooted at the MRCA of the '
+                                f'outgroup: {input_tree}')
+
+        # Root on the edge above the MRCA, this is above either the MRCA's
+        # taxa or the remaining taxa in the original tree.
+        tree.encode_bipartitions()
+        mask_out = tree.taxon_namespace.taxa_bitmask(labels=[x.taxon.label for x in mrca.leaf_iter()])
+        mask_in = tree.seed_node.bipartition.leafset_bitmask ^ mask_out
+        nodes = {n.bipartition.leafset_bitmask: n for n in tree.preorder_node_iter() if n is not tree.seed_node}
+        outgroup_node = nodes.get(mask_out, nodes.get(mask_in))
+        if outgroup_node is None:
+            raise MetaTreeExit(f'The tree could not be rooted on the outgroup: {input_tree}')
+
+        self._reroot(tree, outgroup_node)
+        tree.write_to_path(output_tree,
+                           schema='newick',
+                           suppress_rooting=True,
+                           unquoted_underscores=True)
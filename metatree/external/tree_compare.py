@@ -26,11 +26,14 @@ __status__ = 'Development'
 
 import logging
 import sys
+import weakref
 
 import dendropy
 from biolib.newick import parse_label, create_label
 from dendropy.calculate import treecompare
 
+from metatree.tree_splits import check_rf_taxa
+
 
 class TreeCompare(object):
     """Compare pairs of trees."""
@@ -39,6 +42,7 @@ class TreeCompare(object):
         """Initialization."""
 
         self.logger = logging.getLogger('timestamp')
+        self._rel_dists = weakref.WeakKeyDictionary()
 
     def _check_fractional_bootstraps(self, tree):
         """Check if bootstrap values are between [0, 1] and change to [0, 100]."""
@@ -98,9 +102,12 @@ class TreeCompare(object):
 
         # prune trees to specified taxa
         if taxa_list:
-            taxa_to_keep = set()
-            for line in open(taxa_list):
-                taxa_to_keep.add(line.strip().split('\t')[0])
+            if isinstance(taxa_list, str):
+                taxa_to_keep = set()
+                for line in open(taxa_list):
+                    taxa_to_keep.add(line.strip().split('\t')[0])
+            else:
+                taxa_to_keep = taxa_list
             tree1.retain_taxa_with_labels(taxa_to_keep)
             tree2.retain_taxa_with_labels(taxa_to_keep)
 
@@ -125,11 +132,13 @@ class TreeCompare(object):
     def robinson_foulds(self, tree1, tree2, taxa_list):
         """Calculate Robinson-Foulds (i.e., symmetric_difference) distance between two trees."""
 
+        desc = f'common between {tree1} and {tree2}'
         tree1, tree2 = self._read_trees(tree1, tree2, taxa_list)
 
+        num_taxa = len([t for t in tree1.leaf_node_iter()])
+        check_rf_taxa(num_taxa, desc)
         rf = treecompare.symmetric_difference(tree1, tree2)
 
-        num_taxa = len([t for t in tree1.leaf_node_iter()])
         normalized_rf = float(rf) / (2 * (num_taxa - 3))
 
         return rf, normalized_rf
@@ -174,7 +183,9 @@ class TreeCompare(object):
         """Calculate average rate of divergence for each nodes in a tree.
 
         The average rate is the arithmetic mean of the
-        branch length to all descendant taxa.
+        branch length to all descendant taxa. The number of taxa
+        and mean distance of each node are accumulated from its
+        children in a single postorder pass.
 
         Parameters
         ----------
@@ -183,28 +194,43 @@ class TreeCompare(object):
 
         Returns
         -------
-        The following attributes are added to each node:
-          mean_dist: mean distance to tips
-          num_taxa: number of terminal taxa
+        nodes : list
+            Nodes of the tree in preorder.
+        parent : list
+            Index of the parent of each node (-1 for the root).
+        mean_dist : list
+            Mean distance to tips of each node.
+        num_taxa : list
+            Number of terminal taxa below each node.
         """
 
+        nodes = list(tree.preorder_node_iter())
+        node_idx = {id(node): i for i, node in enumerate(nodes)}
+        parent = [-1 if node.parent_node is None else node_idx[id(node.parent_node)] for node in nodes]
+        children = [list() for _ in nodes]
+        for i in range(1, len(nodes)):
+            children[parent[i]].append(i)
+
         # calculate the mean branch length to extant taxa
-        for node in tree.postorder_node_iter():
+        num_taxa = [1] * len(nodes)
+        mean_dist = [0.0] * len(nodes)
+        for i in range(len(nodes) - 1, -1, -1):
+            if not children[i]:
+                continue
+            num_taxa[i] = sum([num_taxa[c] for c in children[i]])
             avg_div = 0
-            if node.is_leaf():
-                node.mean_dist = 0.0
-                node.num_taxa = 1
-            else:
-                node.num_taxa = sum([1 for _ in node.leaf_iter()])
-                for c in node.child_node_iter():
-                    num_tips = c.num_taxa
-                    avg_div += (float(c.num_taxa) / node.num_taxa) * (c.mean_dist + c.edge_length)
+            for c in children[i]:
+                avg_div += (float(num_taxa[c]) / num_taxa[i]) * (mean_dist[c] + nodes[c].edge_length)
+            mean_dist[i] = avg_div
 
-            node.mean_dist = avg_div
+        return nodes, parent, mean_dist, num_taxa
 
     def _rel_dist(self, tree):
         """Calculate relative distance to each internal node.
 
+        The result is cached, so the tree must not be modified
+        after it is first called.
+
         Parameters
         ----------
         tree : Dendropy Tree
@@ -212,33 +238,35 @@ class TreeCompare(object):
 
         Returns
         -------
-        The following attributes are added to each node:
-          mean_dist: mean distance to tips
-          num_taxa: number of terminal taxa
-          rel_dists: relative distance of node between root and extant organisms
+        dict
+            Relative distance of each node (keyed by id) between root and extant organisms.
         """
 
-        self._avg_descendant_rate(tree)
+        if tree in self._rel_dists:
+            return self._rel_dists[tree]
+
+        nodes, parent, mean_dist, _num_taxa = self._avg_descendant_rate(tree)
 
-        for node in tree.preorder_node_iter():
-            if node == tree.seed_node:
-                node.rel_dist = 0.0
-            elif node.is_leaf():
-                node.rel_dist = 1.0
+        rel_dist = [0.0] * len(nodes)
+        for i in range(1, len(nodes)):
+            if nodes[i].is_leaf():
+                rel_dist[i] = 1.0
             else:
-                a = node.edge_length
-                b = node.mean_dist
-                x = node.parent_node.rel_dist
+                a = nodes[i].edge_length
+                b = mean_dist[i]
+                x = rel_dist[parent[i]]
 
                 if (a + b) != 0:
-                    rel_dist = x + (a / (a + b)) * (1.0 - x)
+                    rel_dist[i] = x + (a / (a + b)) * (1.0 - x)
                 else:
                     # internal node has zero length to parent,
                     # so should have the same relative distance
                     # as the parent node
-                    rel_dist = x
+                    rel_dist[i] = x
 
-                node.rel_dist = rel_dist
+        out = {id(node): d for node, d in zip(nodes, rel_dist)}
+        self._rel_dists[tree] = out
+        return out
 
     def _supported(self, ref_tree, compare_tree, min_support, max_depth):
         """Determine supported bipartitions in reference tree not in comparison tree."""
@@ -251,6 +279,7 @@ class TreeCompare(object):
         nontrivial_splits_w = 0
         congruent_splits = {}
         incongruent_splits = {}
+        rel_dist = self._rel_dist(ref_tree)
         for n in ref_tree.preorder_node_iter(lambda n: not n.is_leaf()):
             if not n.parent_node:
                 continue
@@ -259,7 +288,7 @@ class TreeCompare(object):
             nontrivial_splits_w += n.edge.length
 
             support, label, aux_info = parse_label(n.label)
-            if support is None or (support >= min_support and n.rel_dist <= max_depth):
+            if support is None or (support >= min_support and rel_dist[id(n)] <= max_depth):
                 split_lca = n.child_nodes()[0].leaf_nodes()[0].taxon.label
                 split_lca += '|'
                 split_lca += n.child_nodes()[1].leaf_nodes()[0].taxon.label
@@ -282,6 +311,8 @@ class TreeCompare(object):
         common_supported_splits = 0
         common_supported_splits_w = 0
         null_support = False
+        rel_dist1 = self._rel_dist(tree1)
+        rel_dist2 = self._rel_dist(tree2)
         for n in tree1.preorder_node_iter(lambda n: not n.is_leaf()):
             if not n.parent_node:
                 continue
@@ -290,12 +321,12 @@ class TreeCompare(object):
             if support is None:
                 null_support = True
 
-            if support is None or (support >= min_support and n.rel_dist <= max_depth):
+            if support is None or (support >= min_support and rel_dist1[id(n)] <= max_depth):
                 if n.bipartition in tree2.bipartition_encoding:
                     edge2 = tree2.bipartition_edge_map[n.bipartition]
                     support2, label2, aux_info2 = parse_label(edge2.head_node.label)
 
-                    if support2 is None or (support2 >= min_support and edge2.head_node.rel_dist <= max_depth):
+                    if support2 is None or (support2 >= min_support and rel_dist2[id(edge2.head_node)] <= max_depth):
                         common_supported_splits += 1
                         common_supported_splits_w += n.edge.length + edge2.length
 
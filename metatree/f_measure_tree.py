@@ -1,20 +1,45 @@
+import io
+import json
 import os
 from collections import defaultdict
 
-import dendropy
 import ete3
+from dendropy.dataio.nexusprocessing import escape_nexus_token
+
+from metatree.common import worker_pool
+from metatree.io.f_measure_table import FMeasureTable
+from metatree.io.taxonomy_file import TaxonomyFile
+from metatree.run_report import RunReport, timed_call
+
 
 class FMeasureTree(object):
     """Compares Phylorank output tables and plots differences in a tree."""
 
-    def __init__(self, path_taxonomy):
+    def __init__(self, tf: TaxonomyFile):
         """Initialises the class, requires the shared taxonomy file."""
         self.files = dict()
-        self.tf = TaxonomyFile(path_taxonomy)
+        self.tf = tf
+        self.summary = None
+        self.newick = None
 
     def add_table(self, label, path):
         """Adds a table for comparison."""
         self.files[label] = FMeasureTable(path)
+        self.summary = None
+        self.newick = None
+
+    def order_tables(self, labels):
+        """Order the tables by label, this determines the order of nodes in the tree."""
+        self.files = {x: self.files[x] for x in labels if x in self.files}
+        self.summary = None
+        self.newick = None
+
+    def get_summary(self):
+        """Return the values displayed for each rank, these are only calculated
+        once (until another table is added) and shared between renders."""
+        if self.summary is None:
+            self.summary = RankSummary(self.files, self.get_poly_ranks(), self.get_n_common())
+        return self.summary
 
     def get_n_common(self):
         """Determine the number of genomes which are common between ALL models."""
@@ -23,8 +48,8 @@ class FMeasureTree(object):
         # Index by rank.
         d_rank_model = defaultdict(dict)
         for model_id, fm in self.files.items():
-            for rank, rank_dict in fm.get_content().items():
-                d_rank_model[rank][model_id] = rank_dict
+            for idx, rank in enumerate(fm.taxa):
+                d_rank_model[rank][model_id] = (fm, idx)
 
         # Iterate over each rank and find the number of common taxa.
         for rank, model_dict in d_rank_model.items():
@@ -34,15 +59,15 @@ class FMeasureTree(object):
 
                 # Determine the number of common taxa for all of the models.
                 all_in, all_out = None, None
-                for cur_model_id, cur_model_info in model_dict.items():
+                for cur_model_id, (fm, idx) in model_dict.items():
                     if all_in is None:
-                        all_in = set(cur_model_info['rogue_in'])
+                        all_in = set(fm.get_rogue_in(idx))
                     else:
-                        all_in = all_in.intersection(set(cur_model_info['rogue_in']))
+                        all_in = all_in.intersection(fm.get_rogue_in(idx))
                     if all_out is None:
-                        all_out = set(cur_model_info['rogue_out'])
+                        all_out = set(fm.get_rogue_out(idx))
                     else:
-                        all_out = all_out.intersection(set(cur_model_info['rogue_out']))
+                        all_out = all_out.intersection(fm.get_rogue_out(idx))
 
                 out[rank]['in'] = len(all_in)
                 out[rank]['out'] = len(all_out)
@@ -51,9 +76,8 @@ class FMeasureTree(object):
     def get_poly_ranks(self):
         out = set()
         for model_id, fm in self.files.items():
-            for rank, rank_dict in fm.get_content().items():
-                if rank_dict['f_measure'] < 1.0:
-                    out.add(rank)
+            for idx in fm.get_polyphyletic():
+                out.add(fm.taxa[idx])
         return out
 
     @staticmethod
@@ -75,20 +99,40 @@ class FMeasureTree(object):
         tf.vt_align = 1
         return tf
 
+    def get_newick(self):
+        """Create a newick tree spanning all nodes identified in f-measure tables,
+        this is only created once (until another table is added)."""
+        if self.newick is None:
+            newick = NewickTree(self.tf)
+            [newick.add_nodes(fm) for fm in self.files.values()]
+            self.newick = str(newick)
+        return self.newick
+
     def run(self, legend, out_path, rotation_deg=0):
+        FMeasureTree.render(self.get_newick(), self.get_summary(), legend, out_path, rotation_deg)
+
+    def run_many(self, renders, cpus=1, report: RunReport = None, pool=None):
+        """Render the tree for each (legend, out_path), the format is determined by
+        the extension of out_path (svg, pdf, or png). Each is rendered in its own process,
+        a given pool should not have been forked from a process which has used Qt."""
+        newick, summary = self.get_newick(), self.get_summary()
+        tasks = [(newick, summary, legend, out_path) for legend, out_path in renders]
+        with worker_pool(max(1, min(cpus, len(tasks))), pool, 'spawn') as pool:
+            if report is None:
+                pool.starmap(FMeasureTree.render, tasks)
+            else:
+                results = pool.starmap(timed_call, [(FMeasureTree.render, x) for x in tasks])
+                for task, (_, stats) in zip(tasks, results):
+                    report.add_task(os.path.basename(task[3]), 'render', stats)
+
+    @staticmethod
+    def render(newick, summary, legend, out_path, rotation_deg=0):
 
         # Required for the script to be able to render an output.
         os.environ['QT_QPA_PLATFORM'] = 'offscreen'
 
-        # Create a newick tree spanning all nodes identified in f-measure tables.
-        newick = NewickTree(self.tf)
-        [newick.add_nodes(fm) for fm in self.files.values()]
-
-        # Determine the counts for the common taxa.
-        d_rank_common = self.get_n_common()
-
         # Create an ete3 tree and annotate it
-        t = ete3.Tree(str(newick), format=1, quoted_node_names=True)
+        t = ete3.Tree(newick, format=1, quoted_node_names=True)
         ts = ete3.TreeStyle()
         ts.show_leaf_name = False
         ts.show_scale = False
@@ -122,7 +166,7 @@ class FMeasureTree(object):
                     tf_legend_common_blank = FMeasureTree.get_text_face('X', None, 0.0, fsize=7)
                     ete3.faces.add_face_to_node(tf_legend_common_blank, node, column=1, position="branch-top")
 
-                    for idx, model_id in enumerate(sorted(self.files.keys())):
+                    for idx, model_id in enumerate(summary.model_ids):
                         tf_legend_in = FMeasureTree.get_text_face(f'No. Rogue In ({model_id})', COLOURS[idx], 1.0,
                                                                   fsize=7)
                         ete3.faces.add_face_to_node(tf_legend_in, node, column=2 + idx, position="branch-top")
@@ -136,14 +180,12 @@ class FMeasureTree(object):
                         ete3.faces.add_face_to_node(tf_legend_exp, node, column=2 + idx, position="branch-top")
 
             # Check if this node was not monophyletic in any of the models
-            poly_ranks = self.get_poly_ranks()
-            if node.name in poly_ranks:
+            if node.name in summary.poly_ranks:
 
                 # Create a spacer between the rank name and the values.
                 ete3.faces.add_face_to_node(tf_invis, node, column=1, position="branch-right")
 
-                n_common_in = d_rank_common[node.name]['in']
-                n_common_out = d_rank_common[node.name]['out']
+                n_common_in, n_common_out = summary.common[node.name]
 
                 # Add a spacer to act as a top margin.
                 ete3.faces.add_face_to_node(tf_invis, node, column=2, position="branch-right")
@@ -166,10 +208,7 @@ class FMeasureTree(object):
                 ete3.faces.add_face_to_node(tf_common_blank, node, column=2, position="branch-right")
 
                 # Add model specific information for this current rank.
-                for idx, model_id in enumerate(sorted(self.files.keys())):
-                    cur_f_table = self.files[model_id].content
-                    n_rogue_in = len(cur_f_table[node.name]["rogue_in"])
-                    n_rogue_out = len(cur_f_table[node.name]["rogue_out"])
+                for idx, (n_rogue_in, n_rogue_out, n_expected) in enumerate(summary.models[node.name]):
 
                     # Add a top margin spacer.
                     ete3.faces.add_face_to_node(tf_invis, node, column=3 + idx, position="branch-right")
@@ -189,7 +228,7 @@ class FMeasureTree(object):
                     ete3.faces.add_face_to_node(tf_generic_out, node, column=3 + idx, position="branch-right")
 
                     # Expected number of taxa in this model.
-                    tf_expected_cnt = FMeasureTree.get_text_face(cur_f_table[node.name]["n_expected"], '#f2f2f2', 0.2)
+                    tf_expected_cnt = FMeasureTree.get_text_face(n_expected, '#f2f2f2', 0.2)
                     ete3.faces.add_face_to_node(tf_expected_cnt, node, column=3 + idx, position="branch-right")
 
         ts.layout_fn = my_layout
@@ -201,178 +240,194 @@ class FMeasureTree(object):
             t.render(out_path, tree_style=ts)
 
 
-class TaxonomyFile(object):
-
-    def __init__(self, path):
-        self.path = path
-        self.contents = self.read()
-
-    def read(self):
-        out = dict()
-        with open(self.path, 'r') as f:
-            for line in f.readlines():
-                cols = line.strip().split('\t')
-                accession = cols[0]
-                ranks = cols[1].split(';')
-                out[accession] = ranks
-        return out
-
-    def get_content(self):
-        return self.contents
-
-    def get_taxon_namespace(self):
-        out = set()
-
-        for v in self.contents.values():
-            [out.add(x) for x in v]
-
-        return out
-
-    def get_ranks_above(self, search_str):
-        for v in self.contents.values():
-            last_ranks = list()
-            for rank in v:
-                last_ranks.append(rank)
-                if rank == search_str:
-                    return last_ranks
-
-
-class Node(object):
-
-    def __init__(self, name, parent):
-        self.name = name
-        self.children = list()
-        self.parent = parent
-        self.count = None
-        self.metadata = list()
-
-    def get_name(self):
-        return self.name
-
-    def add_child(self, node):
-        self.children.append(node)
-
-    def get_child(self, name):
-        for child in self.children:
-            if child.get_name() == name:
-                return child
-        return None
-
-    def add_ranks(self, ranks):
-        last_node = self
-        for rank in ranks:
-            search_node = last_node.get_child(rank)
-            if not search_node:
-                new_node = Node(rank, parent=last_node)
-                last_node.add_child(new_node)
-                last_node = new_node
+class RankSummary(object):
+    """The values displayed for each polyphyletic rank in the tree comparison."""
+
+    def __init__(self, files, poly_ranks, n_common):
+        self.model_ids = sorted(files.keys())
+        self.poly_ranks = frozenset(poly_ranks)
+
+        # Number of rogue taxa in/out which are common between ALL models.
+        self.common = {rank: (n_common[rank]['in'], n_common[rank]['out']) if rank in n_common else (0, 0)
+                       for rank in self.poly_ranks}
+
+        # Number of rogue taxa in/out, and expected, for each model (sorted by id).
+        self.models = dict()
+        for model_id in self.model_ids:
+            fm = files[model_id]
+            n_in, n_out, n_expected = fm.n_rogue_in.tolist(), fm.n_rogue_out.tolist(), fm.n_expected.tolist()
+            for rank in self.poly_ranks:
+                idx = fm.taxon_idx[rank]
+                self.models.setdefault(rank, list()).append((n_in[idx], n_out[idx], n_expected[idx]))
+
+
+class TaxonTree(object):
+    """A tree of named nodes stored as parallel arrays, node 0 is the root.
+
+    Names are interned, the children of each node are linked through
+    first_child / next_sibling (in the order they were added), and a child
+    is found by name in constant time. Serialisation is iterative and is
+    streamed to a file handle, so the depth of the tree is not limited.
+    """
+    __slots__ = ('names', 'name_idx', 'name_id', 'parent', 'first_child', 'last_child', 'next_sibling',
+                 'count', 'metadata', 'child_idx')
+
+    def __init__(self, name=None):
+        self.names = list()
+        self.name_idx = dict()
+        self.name_id, self.parent = list(), list()
+        self.first_child, self.last_child, self.next_sibling = list(), list(), list()
+        self.count = list()
+        self.metadata = dict()
+        self.child_idx = dict()
+        self.add_node(name, -1)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _intern(self, name):
+        if name is None:
+            return -1
+        if name not in self.name_idx:
+            self.name_idx[name] = len(self.names)
+            self.names.append(name)
+        return self.name_idx[name]
+
+    def add_node(self, name, parent):
+        """Add a node as the last child of parent (-1 for the root), returns its index."""
+        idx = len(self.parent)
+        name_id = self._intern(name)
+        self.name_id.append(name_id)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.count.append(None)
+        if parent >= 0:
+            if self.first_child[parent] == -1:
+                self.first_child[parent] = idx
             else:
-                last_node = search_node
-        return last_node
-
-    def add_expected_count(self, count):
-        self.count = count
-
-    def __str__(self):
-
-        parent_str = 'null' if self.parent is None else self.parent.get_name()
-
-        expected_str = '' if self.count is None else ',\n"n_expected": %s' % self.count
-        metadata_str = '' if len(self.metadata) == 0 else ',\n"metadata": [\n%s]' % '\n'.join(self.metadata)
-
-        children_str = str()
-        if len(self.children) > 0:
-            children_str = ''',
-            "children": [
-            %s
-            ]''' % ', '.join([str(x) for x in self.children])
-
-        out = '''{
-        "name": "%s",
-        "parent": "%s" %s %s %s 
-    }
-        ''' % (self.name, parent_str, children_str, expected_str, metadata_str)
-
-        return out
-
-    def add_metadata(self, item):
-        self.metadata.append(item)
-
-
-class FMeasureTable(object):
-    cols = ('Taxon', 'No. Expected in Tree', 'F-measure', 'Precision', 'Recall',
-            'No. Genomes from Taxon', 'No. Genome In Lineage', 'Rogue out',
-            'Rogue in')
-
-    def __init__(self, path):
-        self.path = path
-        self.content = self.read()
-
-    def read(self):
-        out = dict()
-        with open(self.path) as fh:
-            read_cols = tuple([x for x in fh.readline().strip().split('\t')])
-            if self.cols != read_cols:
-                raise Exception('PhyloRank output file has different headers.')
-            col_ids = {x: i for i, x in enumerate(self.cols)}
-
-            for line in fh.readlines():
-                vals = [x.strip() for x in line.split('\t')]
-
-                taxon = vals[col_ids['Taxon']]
-                n_expected = int(vals[col_ids['No. Expected in Tree']])
-                f_measure = float(vals[col_ids['F-measure']])
-                precision = float(vals[col_ids['Precision']])
-                recall = float(float(vals[col_ids['Recall']]))
-                n_from_taxon = int(vals[col_ids['No. Genomes from Taxon']])
-                n_from_lineage = int(vals[col_ids['No. Genome In Lineage']])
-                rogue_in = vals[col_ids['Rogue in']]
-                rogue_out = vals[col_ids['Rogue out']]
-
-                hit = dict()
-                hit['n_expected'] = n_expected
-                hit['f_measure'] = f_measure
-                hit['precision'] = precision
-                hit['recall'] = recall
-                hit['n_from_taxon'] = n_from_taxon
-                hit['n_from_lineage'] = n_from_lineage
-                hit['rogue_in'] = list() if len(rogue_in) == 0 else rogue_in.split(',')
-                hit['rogue_out'] = list() if len(rogue_out) == 0 else rogue_out.split(',')
-                out[taxon] = hit
-        return out
-
-    def get_content(self) -> dict:
-        return self.content
+                self.next_sibling[self.last_child[parent]] = idx
+            self.last_child[parent] = idx
+            self.child_idx[(parent, name_id)] = idx
+        return idx
+
+    def get_name(self, idx):
+        name_id = self.name_id[idx]
+        return None if name_id == -1 else self.names[name_id]
+
+    def set_name(self, idx, name):
+        parent = self.parent[idx]
+        if parent >= 0:
+            self.child_idx.pop((parent, self.name_id[idx]), None)
+        name_id = self._intern(name)
+        self.name_id[idx] = name_id
+        if parent >= 0:
+            self.child_idx[(parent, name_id)] = idx
+
+    def get_child(self, idx, name):
+        """Return the index of the child of idx with this name, or None."""
+        return self.child_idx.get((idx, self.name_idx.get(name)))
+
+    def children(self, idx):
+        child = self.first_child[idx]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def add_ranks(self, ranks, idx=0):
+        """Add each rank as a child of the previous (starting from idx), returns the last node."""
+        for rank in ranks:
+            child = self.get_child(idx, rank)
+            idx = self.add_node(rank, idx) if child is None else child
+        return idx
+
+    def add_expected_count(self, idx, count):
+        self.count[idx] = count
+
+    def add_metadata(self, idx, item):
+        self.metadata.setdefault(idx, list()).append(item)
+
+    def write_newick(self, fh):
+        """Write the tree in Newick format, labels are quoted as dendropy would."""
+        stack = [';\n', 0]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                fh.write(item)
+                continue
+            children = list(self.children(item))
+            name = self.get_name(item)
+            label = '' if name is None else escape_nexus_token(name)
+            if len(children) == 0:
+                fh.write(label)
+                continue
+            fh.write('(')
+            stack.append(label)
+            stack.append(')')
+            for i, child in enumerate(reversed(children)):
+                stack.append(child)
+                if i < len(children) - 1:
+                    stack.append(',')
+
+    def write_json(self, fh):
+        """Write the tree as nested JSON objects (name, parent, children, n_expected, metadata)."""
+        stack = [0]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                fh.write(item)
+                continue
+            parent = self.parent[item]
+            fh.write(f'{{"name": {json.dumps(self.get_name(item))}, '
+                     f'"parent": {json.dumps(None if parent == -1 else self.get_name(parent))}')
+
+            # Everything following the children is written once they have been.
+            tail = ''
+            if self.count[item] is not None:
+                tail += f', "n_expected": {json.dumps(self.count[item])}'
+            if item in self.metadata:
+                tail += f', "metadata": {json.dumps(self.metadata[item])}'
+            children = list(self.children(item))
+            if len(children) == 0:
+                fh.write(tail + '}')
+                continue
+            fh.write(', "children": [')
+            stack.append(']' + tail + '}')
+            for i, child in enumerate(reversed(children)):
+                stack.append(child)
+                if i < len(children) - 1:
+                    stack.append(', ')
 
 
 class NewickTree(object):
 
     def __init__(self, tf: TaxonomyFile):
         self.tf = tf
-        self.taxon_namespace = dendropy.TaxonNamespace(self.tf.get_taxon_namespace())
-        self.tree = dendropy.Tree()
-        self.root = self.tree.seed_node
+        self.tree = TaxonTree()
+        self.nodes = dict()
 
     def add_nodes(self, fm: FMeasureTable):
-        for taxon, f_dict in fm.get_content().items():
-
-            # Only constructing nodes which are polyphyletic.
-            if f_dict['f_measure'] >= 1.0:
-                continue
-
-            last_node = self.root
+        # Only constructing nodes which are polyphyletic.
+        for idx in fm.get_polyphyletic():
+            taxon = fm.taxa[idx]
+            last_node = 0
             for cur_rank in self.tf.get_ranks_above(taxon):
-                cur_node = self.tree.find_node_with_taxon_label(cur_rank)
-                if not cur_node:
+                cur_node = self.nodes.get(cur_rank)
+                if cur_node is None:
                     if cur_rank in ['d__Archaea', 'd__Bacteria']:
-                        self.root.taxon = self.taxon_namespace.get_taxon(cur_rank)
-                        cur_node = self.root
+                        self.nodes.pop(self.tree.get_name(0), None)
+                        self.tree.set_name(0, cur_rank)
+                        cur_node = 0
                     else:
-                        new_node = dendropy.Node()
-                        last_node.add_child(new_node)
-                        new_node.taxon = self.taxon_namespace.get_taxon(cur_rank)
-                        cur_node = new_node
+                        cur_node = self.tree.add_node(cur_rank, last_node)
+                    self.nodes[cur_rank] = cur_node
                 last_node = cur_node
 
+    def write(self, fh):
+        self.tree.write_newick(fh)
+
     def __str__(self):
-        return self.tree.as_string('newick')
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
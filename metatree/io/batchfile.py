@@ -1,9 +1,11 @@
 import logging
 import os
+from tqdm import tqdm
 
-import dendropy
-
+from metatree.common import make_sure_path_exists, worker_pool
 from metatree.exception import MetaTreeExit
+from metatree.io.newick import read_leaf_labels
+from metatree.io.parsed_tree import ParsedTree
 
 
 class Batchfile(object):
@@ -12,6 +14,8 @@ class Batchfile(object):
         self.logger = logging.getLogger('timestamp')
         self.path = path
         self.ref, self.data = self.read()
+        self.parsed = dict()
+        self.n_taxa = dict()
 
     def read(self):
         if not os.path.isfile(self.path):
@@ -35,13 +39,82 @@ class Batchfile(object):
             raise MetaTreeExit('Invalid tree paths were present in the batchfile.')
         return ref, out
 
-    def common_taxa(self):
+    def tree_size(self, tree_id):
+        """The estimated cost of processing a tree, i.e. its number of taxa
+        if known, otherwise the size of its file."""
+        n_taxa = self.n_taxa.get(tree_id)
+        return n_taxa if n_taxa is not None else os.path.getsize(self.data[tree_id])
+
+    def by_size(self):
+        """Return the tree ids, largest first (see Batchfile.tree_size)."""
+        return sorted(self.data, key=self.tree_size, reverse=True)
+
+    @staticmethod
+    def preparse_worker(task):
+        tree_id, tree_path, path_parsed = task
+        try:
+            tree = ParsedTree.load(path_parsed, tree_path)
+            if tree is None:
+                tree = ParsedTree.from_newick(tree_path)
+                tree.write(path_parsed, tree_path)
+        except ValueError as e:
+            return tree_id, str(e), None
+        return tree_id, None, len(tree.labels)
+
+    def preparse(self, dir_parsed, cpus=1, pool=None):
+        """Validate every tree and store its topology in dir_parsed, see ParsedTree.
+
+        Trees are only parsed again if they have been modified. The largest
+        trees are parsed first, and the number of taxa in each is recorded.
+
+        The parsed trees are used for the taxa of each tree and the pairwise
+        distances. Rooting reads the input Newick (as GenomeTreeTk does), and
+        decoration and the F-measure stages read the rooted and decorated
+        trees written by the previous stage, which are not the input trees.
+        """
+        make_sure_path_exists(dir_parsed)
+        queue = [(tree_id, self.data[tree_id], os.path.join(dir_parsed, f'{tree_id}.bin'))
+                 for tree_id in self.by_size()]
+        invalid_trees = list()
+        with worker_pool(cpus, pool) as pool:
+            for tree_id, error, n_taxa in tqdm(pool.imap_unordered(Batchfile.preparse_worker, queue),
+                                               total=len(queue)):
+                if error is not None:
+                    invalid_trees.append((tree_id, error))
+                else:
+                    self.n_taxa[tree_id] = n_taxa
+        for tree_id, error in sorted(invalid_trees):
+            self.logger.error(f'The tree for {tree_id} is malformed ({self.data[tree_id]}): {error}')
+        if len(invalid_trees) > 0:
+            raise MetaTreeExit(f'There were {len(invalid_trees)} malformed trees in the batchfile.')
+        self.parsed = {tree_id: path_parsed for tree_id, _, path_parsed in queue}
+
+    @staticmethod
+    def worker(task):
+        tree_id, tree_path, path_parsed = task
+        if path_parsed is not None:
+            return tree_id, set(ParsedTree.load(path_parsed).labels)
+        return tree_id, set(read_leaf_labels(tree_path))
+
+    def tree_taxa(self, cpus=1, pool=None):
+        """Yield the set of taxa in each tree (largest first, in the order they are read)."""
+        queue = [(tree_id, self.data[tree_id], self.parsed.get(tree_id)) for tree_id in self.by_size()]
+        with worker_pool(cpus, pool) as pool:
+            for tree_id, cur_set in pool.imap_unordered(Batchfile.worker, queue):
+                self.n_taxa[tree_id] = len(cur_set)
+                yield cur_set
+
+    def common_taxa(self, cpus=1, pool=None):
         out = set()
-        for tree_id, tree_path in self.data.items():
-            tree = dendropy.Tree.get_from_path(tree_path, schema='newick', preserve_underscores=True)
-            cur_set = {x.label for x in tree.taxon_namespace}
+        for cur_set in self.tree_taxa(cpus, pool):
             if len(out) == 0:
                 out = cur_set
             else:
                 out = out.intersection(cur_set)
         return out
+
+    def all_taxa(self, cpus=1, pool=None):
+        out = set()
+        for cur_set in self.tree_taxa(cpus, pool):
+            out.update(cur_set)
+        return out
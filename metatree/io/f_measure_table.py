@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+
+class FMeasureTable(object):
+    """A PhyloRank decorate table (-table), stored by column.
+
+    The rogue in/out genomes of all taxa are stored in a single array, the
+    genomes of taxon i are genomes[offsets[i]:offsets[i + 1]]. A per-taxon
+    view (as a dictionary) is only created if requested, see get_content.
+    """
+    cols = ('Taxon', 'No. Expected in Tree', 'F-measure', 'Precision', 'Recall',
+            'No. Genomes from Taxon', 'No. Genome In Lineage', 'Rogue out',
+            'Rogue in')
+
+    def __init__(self, path):
+        self.path = path
+        self.content = None
+        self.read()
+
+    def read(self):
+        df = pd.read_csv(self.path, sep='\t', dtype=str, keep_default_na=False, na_filter=False)
+        if self.cols != tuple(x.strip() for x in df.columns):
+            raise Exception('PhyloRank output file has different headers.')
+        df.columns = self.cols
+
+        self.taxa = df['Taxon'].str.strip().tolist()
+        self.taxon_idx = {x: i for i, x in enumerate(self.taxa)}
+        self.n_expected = df['No. Expected in Tree'].astype(np.int64).to_numpy()
+        self.f_measure = df['F-measure'].astype(np.float64).to_numpy()
+        self.precision = df['Precision'].astype(np.float64).to_numpy()
+        self.recall = df['Recall'].astype(np.float64).to_numpy()
+        self.n_from_taxon = df['No. Genomes from Taxon'].astype(np.int64).to_numpy()
+        self.n_from_lineage = df['No. Genome In Lineage'].astype(np.int64).to_numpy()
+
+        # Concatenate the rogue genomes (in, then out) into a single array.
+        genomes = list()
+        offsets = list()
+        for col in ('Rogue in', 'Rogue out'):
+            values = df[col].str.strip()
+            counts = np.where(values == '', 0, values.str.count(',') + 1)
+            offsets.append(len(genomes) + np.concatenate(([0], np.cumsum(counts, dtype=np.int64))))
+            joined = ','.join(values[values != ''])
+            if joined:
+                genomes.extend(joined.split(','))
+        self.genomes = np.array(genomes, dtype=object)
+        self.rogue_in_offsets, self.rogue_out_offsets = offsets
+
+    @property
+    def n_rogue_in(self):
+        return np.diff(self.rogue_in_offsets)
+
+    @property
+    def n_rogue_out(self):
+        return np.diff(self.rogue_out_offsets)
+
+    def get_rogue_in(self, idx):
+        return self.genomes[self.rogue_in_offsets[idx]:self.rogue_in_offsets[idx + 1]].tolist()
+
+    def get_rogue_out(self, idx):
+        return self.genomes[self.rogue_out_offsets[idx]:self.rogue_out_offsets[idx + 1]].tolist()
+
+    def get_polyphyletic(self):
+        """Return the index of each taxon with an F-measure below 1."""
+        return np.flatnonzero(self.f_measure < 1.0)
+
+    def get_content(self) -> dict:
+        """Return a dictionary of values for each taxon, created on the first call."""
+        if self.content is None:
+            self.content = dict()
+            for i, taxon in enumerate(self.taxa):
+                hit = dict()
+                hit['n_expected'] = int(self.n_expected[i])
+                hit['f_measure'] = float(self.f_measure[i])
+                hit['precision'] = float(self.precision[i])
+                hit['recall'] = float(self.recall[i])
+                hit['n_from_taxon'] = int(self.n_from_taxon[i])
+                hit['n_from_lineage'] = int(self.n_from_lineage[i])
+                hit['rogue_in'] = self.get_rogue_in(i)
+                hit['rogue_out'] = self.get_rogue_out(i)
+                self.content[taxon] = hit
+        return self.content
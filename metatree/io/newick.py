@@ -0,0 +1,60 @@
+import re
+
+_RE_WHITESPACE = re.compile(r'\s*')
+_RE_TOKEN = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^\s(),:;'\[\]]+")
+PUNCTUATION = frozenset('(),:;')
+
+
+def unquote(token):
+    """Return the label represented by a (possibly quoted) Newick token."""
+    if token.startswith("'"):
+        return token[1:-1].replace("''", "'")
+    return token
+
+
+def iter_tokens(fh, chunk_size=1 << 20):
+    """Yield the tokens of a Newick file without reading it into memory.
+
+    Punctuation is yielded as a single character, labels and branch lengths
+    are yielded as they appear in the file (i.e. still quoted), and comments
+    are discarded.
+    """
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        pos = _RE_WHITESPACE.match(buf, pos).end()
+        hit = _RE_TOKEN.match(buf, pos)
+
+        # The token may continue past the end of the buffer.
+        if not eof and (hit is None or hit.end() == len(buf)):
+            chunk = fh.read(chunk_size)
+            eof = len(chunk) == 0
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+
+        if hit is None:
+            if pos < len(buf):
+                raise ValueError(f'Unable to parse Newick string near: {buf[pos:pos + 50]}')
+            return
+
+        pos = hit.end()
+        token = hit.group()
+        if not token.startswith('['):
+            yield token
+
+
+def read_leaf_labels(path):
+    """Read the labels of all leaf nodes from a Newick file."""
+    out = list()
+    prev = ';'
+    with open(path) as fh:
+        for token in iter_tokens(fh):
+            if token in PUNCTUATION:
+                prev = token
+            else:
+                if prev in {'(', ',', ';'}:
+                    out.append(unquote(token))
+                prev = None
+    return out
@@ -0,0 +1,155 @@
+import os
+import struct
+
+import numpy as np
+from biolib.newick import parse_label
+
+from metatree.io.newick import iter_tokens, unquote
+
+_MAGIC = b'MTTREv2\n'
+_HEADER = struct.Struct('<8sqqqqq')
+
+
+class ParsedTree(object):
+    """The topology of a Newick tree, stored as arrays.
+
+    Nodes are numbered in preorder (the root is 0), parent[i] is the parent
+    of node i (-1 for the root), and leaf[i] is the index of its label in
+    labels (-1 for internal nodes). The length of the edge above node i is
+    length[i], and the support value of an internal node (parsed from its
+    label) is support[i], both are NaN if absent.
+    """
+
+    def __init__(self, labels, parent, leaf, length, support):
+        self.labels = labels
+        self.parent = parent
+        self.leaf = leaf
+        self.length = length
+        self.support = support
+
+    @staticmethod
+    def from_newick(path):
+        """Parse a single tree from a Newick file, raises ValueError if it is malformed."""
+        labels, label_idx = list(), dict()
+        parent, leaf, length, support = list(), list(), list(), list()
+        stack = list()
+        prev = None
+        last = None
+        with open(path) as fh:
+            for token in iter_tokens(fh):
+                if prev == ';':
+                    raise ValueError('The file contains more than one tree.')
+
+                if token == '(':
+                    if prev not in {None, '(', ','}:
+                        raise ValueError(f'Unexpected "(" after "{prev}".')
+                    parent.append(stack[-1] if stack else -1)
+                    leaf.append(-1)
+                    length.append(np.nan)
+                    support.append(np.nan)
+                    stack.append(len(parent) - 1)
+
+                elif token in {',', ')'}:
+                    if prev in {'(', ','}:
+                        raise ValueError('A leaf node has no label.')
+                    if prev == ':':
+                        raise ValueError('A branch length is missing.')
+                    if not stack:
+                        raise ValueError(f'Unbalanced "{token}".')
+                    if token == ')':
+                        last = stack.pop()
+
+                elif token == ':':
+                    if prev in {None, '(', ',', ':', ';'}:
+                        raise ValueError('Unexpected ":".')
+
+                elif token == ';':
+                    if stack:
+                        raise ValueError('Unbalanced parentheses.')
+                    if prev in {None, ':'}:
+                        raise ValueError('Unexpected ";".')
+
+                # A label, or a branch length.
+                elif prev == ':':
+                    try:
+                        length[last] = float(token)
+                    except ValueError:
+                        raise ValueError(f'Invalid branch length: {token}')
+                    token = 'length'
+
+                elif prev in {None, '(', ','}:
+                    label = unquote(token)
+                    if label in label_idx:
+                        raise ValueError(f'Duplicate leaf label: {label}')
+                    label_idx[label] = len(labels)
+                    labels.append(label)
+                    parent.append(stack[-1] if stack else -1)
+                    leaf.append(label_idx[label])
+                    length.append(np.nan)
+                    support.append(np.nan)
+                    last = len(parent) - 1
+                    token = 'label'
+
+                elif prev == ')':
+                    try:
+                        value = parse_label(unquote(token))[0]
+                    except ValueError:
+                        value = None
+                    if value is not None:
+                        support[last] = value
+                    token = 'label'
+
+                else:
+                    raise ValueError(f'Unexpected label: {token}')
+
+                prev = token
+
+        if stack:
+            raise ValueError('Unbalanced parentheses.')
+        if len(labels) == 0:
+            raise ValueError('The tree has no leaf nodes.')
+        return ParsedTree(labels, np.array(parent, dtype=np.int32), np.array(leaf, dtype=np.int32),
+                          np.array(length, dtype=np.float64), np.array(support, dtype=np.float64))
+
+    @staticmethod
+    def _source_stat(source):
+        stat = os.stat(source)
+        return stat.st_size, stat.st_mtime_ns
+
+    def write(self, path, source):
+        """Write the tree to a binary file which can be memory-mapped, see ParsedTree.load."""
+        names = '\n'.join(self.labels).encode('utf-8')
+        size, mtime = self._source_stat(source)
+        path_tmp = f'{path}.tmp'
+        with open(path_tmp, 'wb') as fh:
+            fh.write(_HEADER.pack(_MAGIC, size, mtime, len(self.parent), len(self.labels), len(names)))
+            fh.write(names)
+            fh.write(b'\0' * (-len(names) % 8))
+            fh.write(np.ascontiguousarray(self.parent, dtype='<i4').tobytes())
+            fh.write(np.ascontiguousarray(self.leaf, dtype='<i4').tobytes())
+            fh.write(np.ascontiguousarray(self.length, dtype='<f8').tobytes())
+            fh.write(np.ascontiguousarray(self.support, dtype='<f8').tobytes())
+        os.replace(path_tmp, path)
+
+    @staticmethod
+    def load(path, source=None):
+        """Memory-map a tree written by ParsedTree.write, returns None if it
+        is missing, or was not created from the current version of source."""
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as fh:
+            header = fh.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                return None
+            magic, size, mtime, n_nodes, n_labels, n_bytes = _HEADER.unpack(header)
+            if magic != _MAGIC:
+                return None
+            if source is not None and (size, mtime) != ParsedTree._source_stat(source):
+                return None
+            labels = fh.read(n_bytes).decode('utf-8').split('\n')[0:n_labels]
+        offset = _HEADER.size + n_bytes + (-n_bytes % 8)
+        parent = np.memmap(path, dtype='<i4', mode='r', offset=offset, shape=(n_nodes,))
+        leaf = np.memmap(path, dtype='<i4', mode='r', offset=offset + 4 * n_nodes, shape=(n_nodes,))
+        length = np.memmap(path, dtype='<f8', mode='r', offset=offset + 8 * n_nodes, shape=(n_nodes,))
+        support = np.memmap(path, dtype='<f8', mode='r', offset=offset + 16 * n_nodes, shape=(n_nodes,))
+        return ParsedTree(labels, parent, leaf, length, support)
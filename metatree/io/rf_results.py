@@ -1,44 +1,203 @@
+import hashlib
 import logging
 import os
 
+import numpy as np
+
 from metatree.common import make_sure_path_exists
 from metatree.exception import MetaTreeExit
 
 
 class RfResults(object):
+    """Pairwise Robinson-Foulds distances (or any other un-normalised and
+    normalised distance, see TreeMetrics), each result is appended to disk
+    as soon as it is added so that an interrupted run can be resumed.
+
+    A manifest of the inputs (the hash of each tree, of the taxa they were
+    restricted to, and the parameters of the metric) is kept next to the
+    results, so that only those results which are still valid are re-used,
+    see RfResults.validate.
+    """
 
-    def __init__(self, path):
+    def __init__(self, path, name='Robinson-Foulds distances'):
         self.logger = logging.getLogger('timestamp')
         self.path = path
-        self.data = self.read()
+        self.name = name
+        self.path_manifest = f'{path}.manifest'
+        self.fh = None
         make_sure_path_exists(os.path.dirname(path))
+        self.data, n_lines = self.read()
+
+        # Compact the file if it was truncated, or contained duplicates.
+        if n_lines != len(self.data):
+            self.write()
+
+    @staticmethod
+    def _number(value):
+        """Parse a distance, keeping integers (e.g. RF) as they were written."""
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
 
     def read(self):
+        """Read the existing results, the last line is kept if a pair was written more than once."""
         out = dict()
+        n_lines = 0
+        n_replaced = 0
         if os.path.isfile(self.path):
             with open(self.path) as fh:
-                for line in fh.readlines():
-                    tid_a, tid_b, rf, norm_rf = line.strip().split('\t')
-                    out[(tid_a, tid_b)] = (float(rf), float(norm_rf))
-        return out
+                for line in fh:
+                    n_lines += 1
+                    cols = line.rstrip('\n').split('\t')
+                    if not line.endswith('\n') or len(cols) != 4:
+                        self.logger.warning(f'Ignoring incomplete line {n_lines:,} in: {self.path}')
+                        continue
+                    tid_a, tid_b, rf, norm_rf = cols
+                    try:
+                        value = (self._number(rf), self._number(norm_rf))
+                    except ValueError:
+                        self.logger.warning(f'Ignoring malformed line {n_lines:,} in: {self.path}')
+                        continue
+                    key = (tid_b, tid_a) if (tid_b, tid_a) in out else (tid_a, tid_b)
+                    if out.get(key, value) != value:
+                        n_replaced += 1
+                    out[key] = value
+        if n_replaced > 0:
+            self.logger.warning(f'{n_replaced:,} pairs had more than one result, the last of each '
+                                f'will be used: {self.path}')
+        return out, n_lines
+
+    def read_manifest(self):
+        """Return the hash of each tree, of the taxa (if any), and the parameters
+        (if any) used by the existing results."""
+        trees, taxa, params = dict(), None, None
+        if os.path.isfile(self.path_manifest):
+            with open(self.path_manifest) as fh:
+                for line in fh:
+                    cols = line.rstrip('\n').split('\t')
+                    if cols[0] == 'tree':
+                        trees[cols[1]] = cols[2]
+                    elif cols[0] == 'taxa':
+                        taxa = cols[1]
+                    elif cols[0] == 'params':
+                        params = cols[1]
+        return trees, taxa, params
+
+    def write_manifest(self, trees, taxa, params=None):
+        path_tmp = f'{self.path_manifest}.tmp'
+        with open(path_tmp, 'w') as fh:
+            if taxa is not None:
+                fh.write(f'taxa\t{taxa}\n')
+            if params is not None:
+                fh.write(f'params\t{params}\n')
+            for tree_id, tree_hash in sorted(trees.items()):
+                fh.write(f'tree\t{tree_id}\t{tree_hash}\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(path_tmp, self.path_manifest)
+
+    @staticmethod
+    def hash_taxa(taxa):
+        """Return the SHA256 of a set of taxa (independent of their order)."""
+        return hashlib.sha256('\n'.join(sorted(taxa)).encode()).hexdigest()
+
+    def validate(self, trees, taxa=None, params=None):
+        """Discard the results which no longer apply to the inputs.
+
+        Parameters
+        ----------
+        trees : Dict[str, str]
+            The hash of each tree in the batchfile, keyed by tree id.
+        taxa : Optional[Iterable[str]]
+            The taxa that each tree is restricted to (if any).
+        params : Optional[str]
+            The parameters of the metric (if any).
+
+        Results for trees which have changed or been removed are discarded.
+        All results are discarded if the taxa or parameters have changed,
+        as every distance depends on them.
+        """
+        old_trees, old_taxa, old_params = self.read_manifest()
+        new_taxa = None if taxa is None else self.hash_taxa(taxa)
+
+        if len(self.data) > 0 and not os.path.isfile(self.path_manifest):
+            self.logger.warning(f'No manifest found, existing results will be re-calculated: {self.path}')
+            stale = set(self.data)
+        elif old_taxa != new_taxa:
+            if len(self.data) > 0:
+                self.logger.warning(f'The set of taxa has changed, existing results will be '
+                                    f're-calculated: {self.path}')
+            stale = set(self.data)
+        elif old_params != params:
+            if len(self.data) > 0:
+                self.logger.warning(f'The parameters have changed, existing results will be '
+                                    f're-calculated: {self.path}')
+            stale = set(self.data)
+        else:
+            valid = {k for k, v in trees.items() if old_trees.get(k) == v}
+            stale = {(a, b) for a, b in self.data if a not in valid or b not in valid}
+            if len(stale) > 0:
+                self.logger.info(f'Discarding {len(stale):,} of {len(self.data):,} existing results '
+                                 f'for trees which have changed: {self.path}')
+
+        # The manifest must reflect the inputs before any new results are appended.
+        if len(stale) > 0:
+            for key in stale:
+                del self.data[key]
+            self.write()
+        self.write_manifest(trees, new_taxa, params)
+
+    @staticmethod
+    def _set(data, tid_a, tid_b, rf, norm_rf):
+        """Store a result, folding the reversed pair into the existing key."""
+        key = (tid_b, tid_a) if (tid_b, tid_a) in data else (tid_a, tid_b)
+        if key in data and data[key] != (rf, norm_rf):
+            raise MetaTreeExit('Inconsistent results, report this issue.')
+        is_new = key not in data
+        data[key] = (rf, norm_rf)
+        return is_new
+
+    def to_matrix(self):
+        """Return the sorted tree ids, and the symmetric un-normalised and normalised distance matrices."""
+        labels = sorted({x for pair in self.data for x in pair})
+        label_idx = {x: i for i, x in enumerate(labels)}
+        mat_rf = np.zeros((len(labels), len(labels)))
+        mat_norm_rf = np.zeros((len(labels), len(labels)))
+        if len(self.data) > 0:
+            rows = np.array([label_idx[tid_a] for tid_a, _ in self.data], dtype=np.int64)
+            cols = np.array([label_idx[tid_b] for _, tid_b in self.data], dtype=np.int64)
+            values = np.array(list(self.data.values()), dtype=np.float64)
+            for mat, col_values in ((mat_rf, values[:, 0]), (mat_norm_rf, values[:, 1])):
+                mat[rows, cols] = col_values
+                mat[cols, rows] = col_values
+        return labels, mat_rf, mat_norm_rf
 
     def is_done(self, tid_a, tid_b):
         return (tid_a, tid_b) in self.data or (tid_b, tid_a) in self.data
 
     def add(self, tid_a, tid_b, rf, norm_rf):
-        self.data[(tid_a, tid_b)] = (rf, norm_rf)
+        if not self._set(self.data, tid_a, tid_b, rf, norm_rf):
+            return
+        if self.fh is None:
+            self.fh = open(self.path, 'a')
+        self.fh.write(f'{tid_a}\t{tid_b}\t{rf}\t{norm_rf}\n')
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
 
     def write(self):
-        done = dict()
-        with open(self.path, 'w') as fh:
+        """Atomically rewrite the results file with one line per pair."""
+        self.close()
+        path_tmp = f'{self.path}.tmp'
+        with open(path_tmp, 'w') as fh:
             for (tid_a, tid_b), (rf, norm_rf) in self.data.items():
-                if (tid_a, tid_b) in done and self.data[(tid_a, tid_b)] != done[(tid_a, tid_b)]:
-                    raise MetaTreeExit('Inconsistent results, report this issue.')
-                if (tid_b, tid_a) in done and self.data[(tid_b, tid_a)] != done[(tid_b, tid_a)]:
-                    raise MetaTreeExit('Inconsistent results, report this issue.')
-                if (tid_a, tid_b) in done or (tid_b, tid_a) in done:
-                    continue
-                else:
-                    fh.write(f'{tid_a}\t{tid_b}\t{rf}\t{norm_rf}\n')
-                    done[(tid_a, tid_b)] = (rf, norm_rf)
-        self.logger.info(f'Pairwise Robinson-Foulds distances written to: {self.path}')
+                fh.write(f'{tid_a}\t{tid_b}\t{rf}\t{norm_rf}\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(path_tmp, self.path)
+        self.logger.info(f'Pairwise {self.name} written to: {self.path}')
@@ -0,0 +1,38 @@
+import hashlib
+import os
+
+from metatree.common import make_sure_path_exists
+
+
+class SharedTaxa(object):
+    """A set of taxa which is written to disk once, and read at most once per process.
+
+    Tasks are given the path instead of the taxa, so that the taxa are not
+    sent with every task to a pool which was created before they were known.
+    The file name is the hash of the taxa, so a path always refers to the
+    same taxa and can be cached by each worker.
+    """
+    _loaded = dict()
+
+    def __init__(self, directory, taxa):
+        self.taxa = sorted(taxa)
+        digest = hashlib.sha256('\n'.join(self.taxa).encode()).hexdigest()
+        self.path = os.path.join(directory, f'taxa_{digest[0:16]}.txt')
+        if not os.path.isfile(self.path):
+            make_sure_path_exists(directory)
+            path_tmp = f'{self.path}.{os.getpid()}.tmp'
+            with open(path_tmp, 'w') as fh:
+                fh.write('\n'.join(self.taxa))
+            os.replace(path_tmp, self.path)
+
+    @staticmethod
+    def load(path):
+        """Return the taxa as a set, and the index of each in sorted order."""
+        out = SharedTaxa._loaded.get(path)
+        if out is None:
+            with open(path) as fh:
+                content = fh.read()
+            taxa = content.split('\n') if content else list()
+            out = (frozenset(taxa), {x: i for i, x in enumerate(taxa)})
+            SharedTaxa._loaded[path] = out
+        return out
@@ -1,29 +1,137 @@
 import logging
 import os
+import struct
+
+import numpy as np
 
 from metatree.exception import MetaTreeExit
 
+_INDEX_MAGIC = b'MTTAXv1\n'
+_INDEX_HEADER = struct.Struct('<8sqqqqq')
+
 
 class TaxonomyFile(object):
+    """The taxonomy of each genome, shared by all stages of the pipeline.
+
+    Each rank name (e.g. p__Firmicutes) is stored once and referenced by an
+    integer id, the lineages are stored as an (n_genomes x 7) int32 array.
+    If path_index is given, the parsed taxonomy is written to a binary file
+    which is memory-mapped (instead of parsed) by later runs.
+    """
 
-    def __init__(self, path):
+    def __init__(self, path, path_index=None):
         self.path = path
-        self.data = self.read()
+        self.path_index = path_index
         self.logger = logging.getLogger('timestamp')
-
-    def read(self):
         if not os.path.isfile(self.path):
             raise MetaTreeExit(f'The taxonomy file does not exist: {self.path}')
-        out = dict()
+
+        self.gids, self.ranks, self.lineages = None, None, None
+        if path_index is None or not self.read_index():
+            self.read()
+            if path_index is not None:
+                self.write_index()
+        self.gid_idx = {gid: i for i, gid in enumerate(self.gids)}
+        self.rank_idx = {rank: i for i, rank in enumerate(self.ranks)}
+        self.ranks_above = None
+
+    def read(self):
+        gids = list()
+        rank_idx = dict()
+        lineages = list()
         invalid_tax = list()
         with open(self.path) as fh:
-            for line in fh.readlines():
+            for line in fh:
                 gid, tax = line.strip().split('\t')
-                out[gid] = tax
-                if len(tax.split(';')) != 7:
+                ranks = [x.strip() for x in tax.split(';')]
+                if len(ranks) != 7:
                     invalid_tax.append((gid, tax))
+                    continue
+                gids.append(gid)
+                lineages.append([rank_idx.setdefault(x, len(rank_idx)) for x in ranks])
         for gid, tax in invalid_tax:
             self.logger.error(f'Genome {gid} does not have a valid taxonomy: {tax}')
         if len(invalid_tax) > 0:
             raise MetaTreeExit(f'There were {len(invalid_tax)} invalid taxonomies detected.')
-        return out
+
+        self.gids = gids
+        self.ranks = list(rank_idx)
+        self.lineages = np.array(lineages, dtype=np.int32).reshape(-1, 7)
+
+    def _source_stat(self):
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def read_index(self):
+        """Memory-map the index, returns False if it is missing or out of date."""
+        if not os.path.isfile(self.path_index):
+            return False
+        with open(self.path_index, 'rb') as fh:
+            header = fh.read(_INDEX_HEADER.size)
+            if len(header) != _INDEX_HEADER.size:
+                return False
+            magic, size, mtime, n_gids, n_ranks, n_bytes = _INDEX_HEADER.unpack(header)
+            if magic != _INDEX_MAGIC or (size, mtime) != self._source_stat():
+                return False
+            names = fh.read(n_bytes).decode('utf-8').split('\n')
+        self.gids = names[0:n_gids]
+        self.ranks = names[n_gids:n_gids + n_ranks]
+        offset = _INDEX_HEADER.size + n_bytes + (-n_bytes % 8)
+        if n_gids == 0:
+            self.lineages = np.zeros((0, 7), dtype=np.int32)
+        else:
+            self.lineages = np.memmap(self.path_index, dtype=np.int32, mode='r', offset=offset,
+                                      shape=(n_gids, 7))
+        self.logger.info(f'Loaded the taxonomy of {n_gids:,} genomes from: {self.path_index}')
+        return True
+
+    def write_index(self):
+        names = '\n'.join(self.gids + self.ranks).encode('utf-8')
+        size, mtime = self._source_stat()
+        path_tmp = f'{self.path_index}.tmp'
+        with open(path_tmp, 'wb') as fh:
+            fh.write(_INDEX_HEADER.pack(_INDEX_MAGIC, size, mtime, len(self.gids), len(self.ranks), len(names)))
+            fh.write(names)
+            fh.write(b'\0' * (-len(names) % 8))
+            fh.write(np.ascontiguousarray(self.lineages, dtype='<i4').tobytes())
+        os.replace(path_tmp, self.path_index)
+
+    def get_lineage(self, gid):
+        """Return the rank names of a genome (domain to species), or None if absent."""
+        idx = self.gid_idx.get(gid)
+        if idx is None:
+            return None
+        return [self.ranks[x] for x in self.lineages[idx]]
+
+    def get_taxonomy(self, gid):
+        """Return the taxonomy string of a genome, or None if absent."""
+        lineage = self.get_lineage(gid)
+        return None if lineage is None else ';'.join(lineage)
+
+    def genomes_in_taxon(self, taxon):
+        """Return the genome ids which are classified as the given taxon."""
+        rank_id = self.rank_idx.get(taxon)
+        if rank_id is None:
+            return set()
+        rows = np.flatnonzero((self.lineages == rank_id).any(axis=1))
+        return {self.gids[x] for x in rows}
+
+    def get_taxon_namespace(self):
+        """Return the name of every rank in the taxonomy."""
+        return set(self.ranks)
+
+    def get_ranks_above(self, taxon):
+        """Return the lineage of the first genome in the taxon, up to and including it."""
+        if self.ranks_above is None:
+            first = dict()
+            for col in range(self.lineages.shape[1]):
+                rank_ids, rows = np.unique(self.lineages[:, col], return_index=True)
+                for rank_id, row in zip(rank_ids.tolist(), rows.tolist()):
+                    if rank_id not in first or (row, col) < first[rank_id]:
+                        first[rank_id] = (row, col)
+            self.ranks_above = first
+        hit = self.ranks_above.get(self.rank_idx.get(taxon))
+        if hit is None:
+            return None
+        row, col = hit
+        return [self.ranks[x] for x in self.lineages[row, 0:col + 1]]
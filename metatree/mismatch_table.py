@@ -1,107 +1,136 @@
 import logging
 import os
-from collections import defaultdict
 
-import pandas as pd
+import numpy as np
 
 from metatree.io import Batchfile
-
-
-class FMeasureTable(object):
-
-    def __init__(self, path):
-        self.path = path
-        self.content = self.read()
-
-    def read(self):
-        out = dict()
-
-        df = pd.read_csv(self.path, delimiter='\t')
-        df_filtered = df[df['F-measure'] < 1.0]
-
-        for idx, row in df_filtered.iterrows():
-            hit = dict()
-            hit['n_expected'] = row['No. Expected in Tree']
-            hit['n_in'] = 0 if str(row['Rogue in']) == 'nan' else len(row['Rogue in'].split(','))
-            hit['g_in'] = list() if str(row['Rogue in']) == 'nan' else row['Rogue in'].split(',')
-            hit['n_out'] = 0 if str(row['Rogue out']) == 'nan' else len(row['Rogue out'].split(','))
-            hit['g_out'] = list() if str(row['Rogue out']) == 'nan' else row['Rogue out'].split(',')
-            out[row['Taxon']] = hit
-
-        return out
-
-    def get_content(self) -> dict:
-        return self.content
-
-
-def parse_tax_file(path):
-    out = dict()
-    with open(path, 'r') as f:
-        for line in f.readlines():
-            gid, tax = line.strip().split('\t')
-            out[gid] = tax
-    return out
-
-
-def tax_to_dict(tax):
-    out = defaultdict(list)
-    for rank in tax.split(';'):
-        out[rank[0]].append(rank)
-    return out
-
-
-def compare_tax(truth, model, comp):
-    n_disagree = 0
-    n_poly = 0
-    n_agree = 0
-
-    for gid, m_tax in comp.items():
-        t_tax = truth[gid]
-
-        t_tax, m_tax = t_tax.replace('; ', ';'), m_tax.replace('; ', ';')
-        dict_t_tax, dict_m_tax = tax_to_dict(t_tax), tax_to_dict(m_tax)
-
-        # Case 1: Agreement
-        if m_tax == t_tax:
-            n_agree += 1
-            continue
-
-        for rank in ['d', 'p', 'c', 'o', 'f', 'g', 's']:
-            m_rank, t_rank = dict_m_tax[rank], dict_t_tax[rank]
-
-            if m_rank == t_rank:
-                continue
-
-            # Case 2: Disagreement
-            elif len(m_rank) == len(t_rank):
-                n_disagree += 1
-
-                print(t_tax)
-                print(m_tax)
-                print('--')
-
-                break
-
-            # Case 3: Polyphyletic / novel rank
-            else:
-                n_poly += 1
-                break
-
-    print(f'{model}\t{n_agree}\t{n_disagree}\t{n_poly}')
-    return model, n_agree, n_disagree, n_poly
+from metatree.io.taxonomy_file import TaxonomyFile
+
+RANKS = ('d', 'p', 'c', 'o', 'f', 'g', 's')
+
+# The rank id of a model taxonomy without a name, or with several names, at a rank.
+MISSING = -1
+MULTIPLE = -2
+
+# The result of comparing the taxonomy of a genome.
+AGREE = 0
+DISAGREE = 1
+POLYPHYLETIC = 2
+NOT_IN_TAXONOMY = 3
+STATUS = ('agree', 'disagree', 'polyphyletic', 'not_in_taxonomy')
+
+
+def read_model_taxonomy(path, truth: TaxonomyFile):
+    """Read a decorated taxonomy (-taxonomy), and encode it using the rank ids of the truth.
+
+    Returns
+    -------
+    Tuple[List[str], List[str], np.ndarray]
+        The genome ids, their taxonomy, and an (n_genomes x 7) int32 array
+        of rank ids. A name which is not in the truth is len(truth.ranks), a
+        rank without a name is MISSING, and one with several names MULTIPLE.
+    """
+    unknown = len(truth.ranks)
+    rank_pos = {x: i for i, x in enumerate(RANKS)}
+    gids, taxonomies, rows = list(), list(), list()
+    with open(path) as fh:
+        for line in fh:
+            gid, tax = line.rstrip('\n').split('\t')
+            row = [MISSING] * len(RANKS)
+            for name in tax.split(';'):
+                name = name.strip()
+                pos = rank_pos.get(name[0:1])
+                if pos is not None:
+                    row[pos] = truth.rank_idx.get(name, unknown) if row[pos] == MISSING else MULTIPLE
+            gids.append(gid)
+            taxonomies.append(tax)
+            rows.append(row)
+    return gids, taxonomies, np.array(rows, dtype=np.int32).reshape(-1, len(RANKS))
+
+
+def compare_tax(truth: TaxonomyFile, gids, model):
+    """Classify the model taxonomy of each genome against the truth.
+
+    A genome agrees if every rank is the same. Otherwise, the first rank
+    which differs determines if it is a disagreement (a different name), or
+    polyphyletic / novel (a missing name, or several names).
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The status of each genome (see STATUS), and the index of the first
+        rank which differs (-1 if none).
+    """
+    rows = np.array([truth.gid_idx.get(x, -1) for x in gids], dtype=np.int64)
+    in_truth = rows >= 0
+    differs = model != np.asarray(truth.lineages)[rows]
+    any_differs = differs.any(axis=1)
+    first = np.where(any_differs, differs.argmax(axis=1), -1)
+
+    status = np.full(len(gids), AGREE, dtype=np.int8)
+    first_model = model[np.arange(len(gids)), np.maximum(first, 0)]
+    status[any_differs & (first_model >= 0)] = DISAGREE
+    status[any_differs & (first_model < 0)] = POLYPHYLETIC
+    status[~in_truth] = NOT_IN_TAXONOMY
+    first[~in_truth] = -1
+    return status, first
 
 
 class MismatchTable(object):
+    """The agreement between the taxonomy of each decorated tree and the truth.
+
+    A summary of each tree is written to path, and each genome which does not
+    agree is written to a detail file (path with a _genomes suffix).
+    """
+    taxonomy = None
 
     def __init__(self, path):
         self.path = path
+        self.path_genomes = f'{os.path.splitext(path)[0]}_genomes.tsv'
         self.logger = logging.getLogger('timestamp')
-
-    def run_and_save(self, batchfile: Batchfile, dir_decorated, path_tax):
-        truth_tax = parse_tax_file(path_tax.path)
-
-        for tree_id, tree_path in batchfile.data.items():
-            cur_tax = parse_tax_file(os.path.join(dir_decorated, f'{tree_id}_rooted_decorated.tree-taxonomy'))
-            compare_tax(truth_tax, tree_id, cur_tax)
-
-        return
+        self.results = dict()
+
+    @staticmethod
+    def worker_init(taxonomy):
+        """Share the taxonomy once per worker process."""
+        MismatchTable.taxonomy = taxonomy
+
+    @staticmethod
+    def worker(tree_id, path):
+        truth = MismatchTable.taxonomy
+        gids, taxonomies, model = read_model_taxonomy(path, truth)
+        status, first = compare_tax(truth, gids, model)
+
+        counts = np.bincount(status, minlength=len(STATUS)).tolist()
+        lines = list()
+        for i in np.flatnonzero(status != AGREE).tolist():
+            rank = RANKS[first[i]] if first[i] >= 0 else ''
+            lines.append(f'{tree_id}\t{gids[i]}\t{STATUS[status[i]]}\t{rank}\t'
+                         f'{truth.get_taxonomy(gids[i]) or ""}\t{taxonomies[i]}\n')
+        return tree_id, counts, ''.join(lines)
+
+    @staticmethod
+    def path_taxonomy(dir_decorated, tree_id):
+        return os.path.join(dir_decorated, f'{tree_id}_rooted_decorated.tree-taxonomy')
+
+    def add(self, result):
+        """Store the result of MismatchTable.worker."""
+        tree_id, counts, lines = result
+        self.results[tree_id] = (counts, lines)
+
+    def write(self, tree_ids):
+        """Write the summary and detail of each tree, in the order given."""
+        with open(self.path, 'w') as fh, open(self.path_genomes, 'w') as fh_genomes:
+            fh.write('Model\tNo. Agree\tNo. Disagree\tNo. Polyphyletic\tNo. Not In Taxonomy\n')
+            fh_genomes.write('Model\tGenome\tStatus\tRank\tTaxonomy\tModel Taxonomy\n')
+            for tree_id in tree_ids:
+                counts, lines = self.results[tree_id]
+                fh.write('\t'.join(map(str, [tree_id] + counts)) + '\n')
+                fh_genomes.write(lines)
+        self.logger.info(f'Taxonomic agreement of each tree written to: {self.path}')
+
+    def run_and_save(self, batchfile: Batchfile, dir_decorated, tax_file: TaxonomyFile):
+        MismatchTable.worker_init(tax_file)
+        for tree_id in batchfile.data:
+            self.add(MismatchTable.worker(tree_id, self.path_taxonomy(dir_decorated, tree_id)))
+        self.write(batchfile.data)
@@ -0,0 +1,80 @@
+import numpy as np
+from Bio.Phylo import BaseTree
+
+
+def neighbour_joining(labels, mat):
+    """Construct a neighbour-joining tree from a dense distance matrix.
+
+    This is a vectorised version of BioPython's DistanceTreeConstructor.nj,
+    the tree (including node names, branch lengths, and the order in which
+    equal pairs are joined) is identical.
+
+    Parameters
+    ----------
+    labels : List[str]
+        The name of each row/column in mat.
+    mat : np.ndarray
+        A symmetric (n x n) distance matrix.
+
+    Returns
+    -------
+    Bio.Phylo.BaseTree.Tree
+        The unrooted neighbour-joining tree.
+    """
+    dm = np.array(mat, dtype=np.float64)
+    clades = [BaseTree.Clade(None, name) for name in labels]
+
+    if len(clades) == 1:
+        return BaseTree.Tree(clades[0], rooted=False)
+    elif len(clades) == 2:
+        clade1, clade2 = clades[1], clades[0]
+        clade1.branch_length = dm[1, 0] / 2.0
+        clade2.branch_length = dm[1, 0] - clade1.branch_length
+        inner_clade = BaseTree.Clade(None, 'Inner')
+        inner_clade.clades.extend((clade1, clade2))
+        return BaseTree.Tree(inner_clade, rooted=False)
+
+    inner_count = 0
+    inner_clade = None
+    while len(dm) > 2:
+        n = len(dm)
+
+        # Summed sequentially (as BioPython does) so that ties are resolved identically.
+        node_dist = np.cumsum(dm, axis=1)[:, -1] / (n - 2)
+
+        # The first minimum in the (row-major) lower triangle is joined.
+        q = dm - node_dist[:, None] - node_dist[None, :]
+        rows, cols = np.tril_indices(n, -1)
+        idx = int(np.argmin(q[rows, cols]))
+        min_i, min_j = (0, 1) if idx == 0 else (int(rows[idx]), int(cols[idx]))
+
+        # Join the pair under a new clade.
+        clade1, clade2 = clades[min_i], clades[min_j]
+        inner_count += 1
+        inner_clade = BaseTree.Clade(None, f'Inner{inner_count}')
+        inner_clade.clades.extend((clade1, clade2))
+        clade1.branch_length = (dm[min_i, min_j] + node_dist[min_i] - node_dist[min_j]) / 2.0
+        clade2.branch_length = dm[min_i, min_j] - clade1.branch_length
+
+        # The new clade replaces min_j, then min_i is removed.
+        clades[min_j] = inner_clade
+        del clades[min_i]
+        new_dist = (dm[min_i] + dm[min_j] - dm[min_i, min_j]) / 2.0
+        new_dist[min_j] = dm[min_j, min_j]
+        dm[min_j, :] = new_dist
+        dm[:, min_j] = new_dist
+        dm = np.delete(np.delete(dm, min_i, axis=0), min_i, axis=1)
+
+    # Attach the last clade to the most recently created clade.
+    if clades[0] is inner_clade:
+        clades[0].branch_length = 0
+        clades[1].branch_length = dm[1, 0]
+        clades[0].clades.append(clades[1])
+        root = clades[0]
+    else:
+        clades[0].branch_length = dm[1, 0]
+        clades[1].branch_length = 0
+        clades[1].clades.append(clades[0])
+        root = clades[1]
+
+    return BaseTree.Tree(root, rooted=False)
@@ -1,64 +1,145 @@
 import logging
 import os
 
-from metatree.common import make_sure_path_exists
+from metatree.cache import ArtifactCache
+from metatree.common import make_sure_path_exists, worker_pool
 from metatree.f_measure_tree import FMeasureTree
 from metatree.io import Batchfile, RfResults
 from metatree.io.taxonomy_file import TaxonomyFile
+from metatree.mismatch_table import MismatchTable
+from metatree.run_report import RunReport
+from metatree.task_graph import TaskGraph
 from metatree.tree_decorate import TreeDecorate
 from metatree.tree_dist import TreeDist
+from metatree.tree_metrics import METRICS
 from metatree.tree_root import TreeRoot
 
 
-def run_pipeline(batchfile: Batchfile, out_dir: str, tax_file: TaxonomyFile, outgroup: str, cpus: int):
+def worker_init(taxonomy):
+    """Share the read-only state required by each stage once per worker process."""
+    TreeDecorate.worker_init(taxonomy)
+    MismatchTable.worker_init(taxonomy)
+
+
+def run_pipeline(batchfile: Batchfile, out_dir: str, tax_file: TaxonomyFile, outgroup: str, cpus: int,
+                 rf_method: str = 'pairwise', root_engine: str = 'native', decorate_engine: str = 'native',
+                 cache_dir: str = None, cache_size: float = None, formats=('svg',),
+                 annot_max: int = 50, trace: bool = False, metrics=('rf',), min_support: float = 50.0,
+                 max_depth: float = 1.0, start_method: str = None):
     logger = logging.getLogger('timestamp')
+    report = RunReport(cpus)
 
     # Setup output paths.
     dir_root = os.path.join(out_dir, 'intermediate_results', 'trees_rooted')
     dir_dec = os.path.join(out_dir, 'intermediate_results', 'trees_decorated')
+    dir_parsed = os.path.join(out_dir, 'intermediate_results', 'trees_parsed')
 
-    dir_rf_common = os.path.join(out_dir, 'results', 'robinson_foulds_common_taxa')
-    dir_rf_all = os.path.join(out_dir, 'results', 'robinson_foulds_all_taxa')
-    make_sure_path_exists(dir_rf_common)
-    make_sure_path_exists(dir_rf_all)
-    rf_common = RfResults(os.path.join(dir_rf_common, 'rf_common_taxa.tsv'))
-    rf_all = RfResults(os.path.join(dir_rf_all, 'rf_all_taxa.tsv'))
+    # The pairwise distances of each metric, over the common taxa and all taxa.
+    dist_results = dict()
+    for metric in metrics:
+        dir_name, prefix, name = METRICS[metric]
+        for common_taxa, suffix in ((True, 'common_taxa'), (False, 'all_taxa')):
+            dir_metric = os.path.join(out_dir, 'results', f'{dir_name}_{suffix}')
+            make_sure_path_exists(dir_metric)
+            dist_results[(metric, common_taxa)] = (
+                RfResults(os.path.join(dir_metric, f'{prefix}_{suffix}.tsv'), f'{name} distances'), dir_metric)
 
-    # tbl_diff = os.path.join(out_dir, 'results', 'model_taxonomy_diff.tsv')
+    mmt = MismatchTable(os.path.join(out_dir, 'results', 'model_taxonomy_diff.tsv'))
 
-    # Root the trees.
-    tree_root = TreeRoot(dir_root)
-    tree_root.run(batchfile, dir_root, outgroup, tax_file, cpus)
+    # Intermediate results are only re-used if they were created from the same inputs.
+    cache = ArtifactCache(cache_dir, None if cache_size is None else int(cache_size * 1e9))
+    tree_root = TreeRoot(dir_root, root_engine, cache)
+    tree_decorate = TreeDecorate(dir_dec, decorate_engine, cache)
+    td = TreeDist()
+    fmt = FMeasureTree(tax_file)
 
-    # Decorate the trees.
-    tree_decorate = TreeDecorate(dir_dec)
-    tree_decorate.run(batchfile, dir_root, dir_dec, tax_file, cpus)
+    # A single pool is created and used by every stage, so that each worker
+    # process (and the taxonomy it holds) is only created once.
+    with worker_pool(cpus, start_method=start_method, initializer=worker_init, initargs=(tax_file,)) as pool:
 
-    # Pairwise comparison of all trees.
-    td = TreeDist()
-    td.run(rf_common, batchfile, dir_root, dir_dec, cpus, common_taxa=True)
-    td.run(rf_all, batchfile, dir_root, dir_dec, cpus, common_taxa=False)
-
-    # Summarise the pairwise distances (trees + heatmap)
-    logger.info(f'Writing pairwise Robinson-Foulds distances for common taxa to: {dir_rf_common}')
-    td.summarise_dist(rf_common, dir_rf_common)
-    logger.info(f'Writing pairwise Robinson-Foulds distances for all taxa to: {dir_rf_all}')
-    td.summarise_dist(rf_all, dir_rf_all)
-
-    # Summarise the differences between all models and the reference.
-    # mmt = MismatchTable(tbl_diff)
-    # mmt.run_and_save(batchfile, dir_dec, tax_file)
-
-    # Create the tree-of-trees comparison.
-    fmt = FMeasureTree(tax_file.path)
-    for tree_id, tree_path in batchfile.data.items():
-        if tree_id != batchfile.ref:
-            fmt.add_table(tree_id, os.path.join(dir_dec, f'{tree_id}_rooted_decorated.tree-table'))
-    for legend in (True, False):
-        if legend:
-            the_path = os.path.join(out_dir, 'results', 'tree_comparison_legend.svg')
-        else:
-            the_path = os.path.join(out_dir, 'results', 'tree_comparison.svg')
-        fmt.run(legend=legend, out_path=the_path)
+        # Validate and parse each tree before any work is done.
+        logger.info('Validating the trees in the batchfile.')
+        with report.stage('validate'):
+            batchfile.preparse(dir_parsed, cpus, pool)
+
+        with report.stage('common_taxa'):
+            set_common = batchfile.common_taxa(cpus, pool)
+        logger.info(f'Tree distances for common taxa will only consider those {len(set_common):,} '
+                    f'taxa which are common between ALL trees.')
+
+        # Only compare the pairs of trees which are new, or have changed since the last run.
+        with report.stage('hash_trees'):
+            tree_hashes = {k: cache.hash_file(v) for k, v in batchfile.data.items()}
+            for (metric, common_taxa), (results, _) in dist_results.items():
+                params = f'min_support={min_support},max_depth={max_depth}' if metric == 'supported_splits' else None
+                results.validate(tree_hashes, set_common if common_taxa else None, params)
+
+        # Each tree is rooted, decorated, and then its table is loaded as soon
+        # as the previous stage for that tree has completed.
+        graph = TaskGraph()
+        with report.stage('queue'):
+            for task in tree_root.queue(batchfile, dir_root, outgroup, tax_file):
+                graph.add(('root', task[0]), tree_root.get_worker(), (task,), callback=tree_root.done,
+                          cost=batchfile.tree_size(task[0]))
+            for task in tree_decorate.queue(batchfile, dir_root, dir_dec, tax_file, tree_root.keys):
+                graph.add(('decorate', task[0]), tree_decorate.get_worker(), (task,), deps=[('root', task[0])],
+                          callback=tree_decorate.done, cost=batchfile.tree_size(task[0]))
+            for tree_id in batchfile.data:
+                if tree_id != batchfile.ref:
+                    graph.add(('table', tree_id), fmt.add_table,
+                              (tree_id, os.path.join(dir_dec, f'{tree_id}_rooted_decorated.tree-table')),
+                              deps=[('decorate', tree_id)], local=True)
+
+            # The agreement between the taxonomy of each decorated tree and the truth.
+            for tree_id in batchfile.data:
+                graph.add(('mismatch', tree_id), MismatchTable.worker,
+                          (tree_id, MismatchTable.path_taxonomy(dir_dec, tree_id)),
+                          deps=[('decorate', tree_id)], callback=mmt.add, cost=batchfile.tree_size(tree_id))
+
+            # Pairwise comparison of all trees, these use the input trees so can be
+            # run whenever a worker would otherwise be idle. Other metrics are
+            # calculated together (including RF), from a single encoding of each tree.
+            for common_taxa in (True, False):
+                if tuple(metrics) == ('rf',):
+                    td.add_tasks(graph, dist_results[('rf', common_taxa)][0], batchfile, common_taxa, rf_method,
+                                 set_common, dir_parsed, cpus, priority=1, pool=pool)
+                else:
+                    td.add_metric_tasks(graph, {x: dist_results[(x, common_taxa)][0] for x in metrics}, batchfile,
+                                        common_taxa, set_common, dir_parsed, cpus, min_support, max_depth,
+                                        priority=1, pool=pool)
+
+        logger.info(f'Rooting trees using {tree_root.description}, decorating trees using '
+                    f'{tree_decorate.description}, and calculating pairwise distances ({", ".join(metrics)}).')
+        with report.stage('tasks'):
+            graph.run(cpus, report=report, pool=pool)
+            fmt.order_tables(batchfile.data)
+            mmt.write(batchfile.data)
+            for results, _ in dist_results.values():
+                results.write()
+
+        # Summarise the pairwise distances (trees + heatmap)
+        summaries = list()
+        for (metric, common_taxa), (results, dir_metric) in dist_results.items():
+            _, prefix, name = METRICS[metric]
+            logger.info(f'Writing pairwise {name} distances for {"common" if common_taxa else "all"} '
+                        f'taxa to: {dir_metric}')
+            summaries.extend(td.summary_tasks(results, dir_metric, annot_max, prefix, name))
+        with report.stage('summarise_dist'):
+            td.summarise_many(summaries, cpus, report, pool)
+
+        # Create the tree-of-trees comparison, each output is rendered concurrently.
+        renders = list()
+        for fmt_ext in formats:
+            renders.append((True, os.path.join(out_dir, 'results', f'tree_comparison_legend.{fmt_ext}')))
+            renders.append((False, os.path.join(out_dir, 'results', f'tree_comparison.{fmt_ext}')))
+        logger.info(f'Rendering the tree comparison ({", ".join(formats)}).')
+        with report.stage('render'):
+            # Forked workers may inherit Qt state, so these are run on a spawned pool unless the pool is not forked.
+            fmt.run_many(renders, cpus, report, pool if start_method in {'spawn', 'forkserver'} else None)
+
+    # Record the resources used by each stage.
+    report.write(os.path.join(out_dir, 'run_report.json'))
+    if trace:
+        report.write_trace(os.path.join(out_dir, 'run_trace.json'))
 
     return
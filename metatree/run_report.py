@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from metatree import __version__
+
+
+def _io_bytes():
+    """Return the bytes read and written by this process (None if unavailable)."""
+    try:
+        with open('/proc/self/io') as fh:
+            values = dict(line.split(': ') for line in fh.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _usage():
+    """Return a snapshot of the resources used by this process and its (reaped) children."""
+    times = os.times()
+    read_bytes, write_bytes = _io_bytes()
+    return {'time': time.time(),
+            'cpu': times.user + times.system,
+            'cpu_children': times.children_user + times.children_system,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'max_rss_children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes}
+
+
+def _diff(before, after, key):
+    if before[key] is None or after[key] is None:
+        return None
+    return after[key] - before[key]
+
+
+def timed_call(fn, args):
+    """Run fn(*args) and return its result with the resources it used (in this process)."""
+    before = _usage()
+    result = fn(*args)
+    after = _usage()
+    return result, {'start': before['time'],
+                    'wall': after['time'] - before['time'],
+                    'cpu': after['cpu'] - before['cpu'],
+                    'max_rss_kb': after['max_rss_kb'],
+                    'read_bytes': _diff(before, after, 'read_bytes'),
+                    'write_bytes': _diff(before, after, 'write_bytes'),
+                    'pid': os.getpid()}
+
+
+class RunReport(object):
+    """Records the wall time, CPU time, peak memory and I/O of each stage and task of a run.
+
+    The CPU time and I/O of a stage include worker processes once their pool
+    has closed, the resources of each task are recorded in its worker. The
+    report is written as JSON, and can also be written as a Chrome trace
+    (chrome://tracing or https://ui.perfetto.dev).
+    """
+
+    def __init__(self, cpus=None):
+        self.logger = logging.getLogger('timestamp')
+        self.cpus = cpus
+        self.start = _usage()
+        self.stages = list()
+        self.tasks = list()
+
+    @contextmanager
+    def stage(self, name):
+        before = _usage()
+        try:
+            yield
+        finally:
+            after = _usage()
+            self.stages.append({'name': name,
+                                'start': before['time'],
+                                'wall': after['time'] - before['time'],
+                                'cpu': after['cpu'] - before['cpu'],
+                                'cpu_children': after['cpu_children'] - before['cpu_children'],
+                                'max_rss_kb': after['max_rss_kb'],
+                                'max_rss_children_kb': after['max_rss_children_kb'],
+                                'read_bytes': _diff(before, after, 'read_bytes'),
+                                'write_bytes': _diff(before, after, 'write_bytes')})
+
+    def add_task(self, name, category, stats, local=False):
+        """Record a task, stats are those returned by timed_call."""
+        self.tasks.append({'name': name, 'category': category, 'local': local, **stats})
+
+    def summarise_tasks(self):
+        """Return the number of tasks, and their total wall/CPU time and I/O for each category."""
+        out = defaultdict(lambda: {'n': 0, 'wall': 0.0, 'cpu': 0.0, 'read_bytes': 0, 'write_bytes': 0})
+        for task in self.tasks:
+            cur = out[task['category']]
+            cur['n'] += 1
+            cur['wall'] += task['wall']
+            cur['cpu'] += task['cpu']
+            cur['read_bytes'] += task['read_bytes'] or 0
+            cur['write_bytes'] += task['write_bytes'] or 0
+        for cur in out.values():
+            cur['throughput_per_s'] = cur['n'] / cur['wall'] if cur['wall'] > 0 else None
+        return dict(out)
+
+    def write(self, path):
+        end = _usage()
+        report = {'version': __version__,
+                  'cpus': self.cpus,
+                  'start': self.start['time'],
+                  'wall': end['time'] - self.start['time'],
+                  'cpu': end['cpu'] - self.start['cpu'],
+                  'cpu_children': end['cpu_children'] - self.start['cpu_children'],
+                  'max_rss_kb': end['max_rss_kb'],
+                  'max_rss_children_kb': end['max_rss_children_kb'],
+                  'stages': self.stages,
+                  'task_summary': self.summarise_tasks(),
+                  'tasks': self.tasks}
+        with open(path, 'w') as fh:
+            json.dump(report, fh, indent=2)
+        self.logger.info(f'Run report written to: {path}')
+
+    def write_trace(self, path):
+        """Write the stages and tasks in the Chrome trace event format."""
+        pid = os.getpid()
+        t0 = self.start['time']
+        events = list()
+        for stage in self.stages:
+            events.append({'name': stage['name'], 'cat': 'stage', 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': (stage['start'] - t0) * 1e6, 'dur': stage['wall'] * 1e6,
+                           'args': {'cpu': stage['cpu'], 'cpu_children': stage['cpu_children']}})
+        for task in self.tasks:
+            events.append({'name': task['name'], 'cat': task['category'], 'ph': 'X', 'pid': task['pid'],
+                           'tid': 1, 'ts': (task['start'] - t0) * 1e6, 'dur': task['wall'] * 1e6,
+                           'args': {'cpu': task['cpu'], 'max_rss_kb': task['max_rss_kb'],
+                                    'read_bytes': task['read_bytes'], 'write_bytes': task['write_bytes']}})
+        with open(path, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+        self.logger.info(f'Chrome trace written to: {path}')
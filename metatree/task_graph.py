@@ -0,0 +1,103 @@
+import heapq
+import logging
+import queue
+
+from tqdm import tqdm
+
+from metatree.common import worker_pool
+from metatree.exception import MetaTreeException
+from metatree.run_report import RunReport, timed_call
+
+
+class TaskGraph(object):
+    """Runs tasks on a single worker pool as soon as their dependencies are met.
+
+    At most one task per worker is submitted at a time, so a task which
+    becomes ready is started ahead of any queued task of a lower priority
+    (i.e. a greater value). Tasks of the same priority are started in order
+    of their estimated cost (greatest first), so that the largest tasks do
+    not run alone at the end. Local tasks are run in this process, and each
+    callback is run in this process with the result of its task.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('timestamp')
+        self.tasks = dict()
+
+    def add(self, key, fn, args=(), deps=(), callback=None, priority=0, local=False, cost=0):
+        """Add a task, dependencies which are not in the graph are assumed to be met."""
+        if key in self.tasks:
+            raise MetaTreeException(f'Duplicate task: {key}')
+        self.tasks[key] = (fn, args, tuple(deps), callback, priority, local, cost)
+
+    def run(self, cpus, initializer=None, initargs=(), report: RunReport = None, pool=None):
+        """Run all tasks, the resources used by each are recorded if a report is given.
+
+        The tasks are run on pool if one is given (initializer is not used),
+        otherwise a new pool is created.
+        """
+        n_deps = dict()
+        dependents = {key: list() for key in self.tasks}
+        for key, (_, _, deps, _, _, _, _) in self.tasks.items():
+            deps = [x for x in deps if x in self.tasks]
+            n_deps[key] = len(deps)
+            for dep in deps:
+                dependents[dep].append(key)
+
+        ready = list()
+        order = {key: i for i, key in enumerate(self.tasks)}
+
+        def push(key):
+            heapq.heappush(ready, (self.tasks[key][4], -self.tasks[key][6], order[key], key))
+
+        [push(key) for key, n in n_deps.items() if n == 0]
+
+        done = queue.Queue()
+        n_running = 0
+        with worker_pool(cpus, pool, initializer=initializer, initargs=initargs) as pool:
+            with tqdm(total=len(self.tasks)) as p_bar:
+                while n_running > 0 or len(ready) > 0:
+
+                    # Run local tasks immediately, and keep every worker busy.
+                    while len(ready) > 0:
+                        key = ready[0][-1]
+                        fn, args, _, _, _, local, _ = self.tasks[key]
+                        if report is not None:
+                            fn, args = timed_call, (fn, args)
+                        if local:
+                            heapq.heappop(ready)
+                            done.put((key, True, fn(*args)))
+                        elif n_running < cpus:
+                            heapq.heappop(ready)
+                            pool.apply_async(fn, args,
+                                             callback=lambda r, k=key: done.put((k, True, r)),
+                                             error_callback=lambda e, k=key: done.put((k, False, e)))
+                        else:
+                            break
+                        n_running += 1
+
+                    if n_running == 0:
+                        break
+
+                    # Wait for the next task to complete.
+                    key, success, result = done.get()
+                    n_running -= 1
+                    if not success:
+                        raise result
+                    if report is not None:
+                        result, stats = result
+                        report.add_task('/'.join(map(str, key)) if isinstance(key, tuple) else str(key),
+                                        key[0] if isinstance(key, tuple) else str(key), stats,
+                                        local=self.tasks[key][5])
+                    callback = self.tasks[key][3]
+                    if callback is not None:
+                        callback(result)
+                    for dependent in dependents[key]:
+                        n_deps[dependent] -= 1
+                        if n_deps[dependent] == 0:
+                            push(dependent)
+                    p_bar.update()
+
+        n_blocked = len([x for x in n_deps.values() if x > 0])
+        if n_blocked > 0:
+            raise MetaTreeException(f'{n_blocked} tasks could not be run due to circular dependencies.')
@@ -1,23 +1,47 @@
 import logging
 import os
 import subprocess
-from multiprocessing import Pool
+from bisect import bisect_left
+from collections import defaultdict
 
+import dendropy
+import numpy as np
+from biolib.newick import parse_label, create_label
 from phylorank import __version__ as phylorank_v
 from tqdm import tqdm
 
-from metatree.common import make_sure_path_exists
+from metatree.cache import ArtifactCache
+from metatree.common import make_sure_path_exists, worker_pool
 from metatree.exception import MetaTreeExit
 from metatree.io import Batchfile
 from metatree.io.taxonomy_file import TaxonomyFile
 
 
+RANK_PREFIXES = ('d__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__')
+RANK_LABELS = ('domain', 'phylum', 'class', 'order', 'family', 'genus', 'species')
+TABLE_COLS = ('Taxon', 'No. Expected in Tree', 'F-measure', 'Precision', 'Recall',
+              'No. Genomes from Taxon', 'No. Genome In Lineage', 'Rogue out', 'Rogue in')
+
+
+def sort_taxa(taxa):
+    """Sort taxa by rank and then alphabetically."""
+    return sorted(taxa, key=lambda x: (RANK_PREFIXES.index(x[0:3]), x))
+
+
 class TreeDecorate(object):
+    taxonomy = None
 
-    def __init__(self, dir_root):
+    def __init__(self, dir_root, engine='native', cache: ArtifactCache = None):
         self.dir_root = dir_root
+        self.engine = engine
+        self.cache = cache
+        self.keys = dict()
         self.logger = logging.getLogger('timestamp')
         make_sure_path_exists(dir_root)
+        if engine == 'native':
+            self.description = f'in-process decoration (Phylorank v{phylorank_v} method)'
+        else:
+            self.description = f'Phylorank v{phylorank_v}'
 
     @staticmethod
     def worker(task):
@@ -27,18 +51,260 @@ class TreeDecorate(object):
         proc.communicate()
         if not proc.returncode == 0:
             raise MetaTreeExit(f'Non-zero return code: {" ".join(args)}')
+        return tree_id
+
+    @staticmethod
+    def worker_init(taxonomy):
+        """Share the taxonomy once per worker process."""
+        TreeDecorate.taxonomy = taxonomy
+
+    @staticmethod
+    def worker_native(task):
+        tree_id, tree_in, tree_out, _ = task
+        NativeDecorate(TreeDecorate.taxonomy).run(tree_in, tree_out)
+        return tree_id
+
+    def get_worker(self):
+        return TreeDecorate.worker_native if self.engine == 'native' else TreeDecorate.worker
+
+    @staticmethod
+    def outputs(tree_out):
+        """All files which are created when decorating a tree."""
+        return [tree_out] + [f'{tree_out}{x}' for x in ('-table', '-summary', '-taxonomy')]
+
+    def queue(self, batchfile: Batchfile, dir_root: str, dir_dec: str, tax_file: TaxonomyFile, root_keys=None):
+        """Return a task for each tree which has not yet been decorated.
 
-    def run(self, batchfile: Batchfile, dir_root: str, dir_dec: str, tax_file: TaxonomyFile, cpus: int):
+        If a cache is used, the keys of the rooted trees (TreeRoot.keys) are required.
+        """
         queue = list()
         for tree_id, tree_in in batchfile.data.items():
             tree_root = os.path.join(dir_root, f'{tree_id}_rooted.tree')
             tree_out = os.path.join(dir_dec, f'{tree_id}_rooted_decorated.tree')
+            if self.cache is None:
+                if os.path.isfile(tree_out):
+                    continue
+            else:
+                key = self.cache.make_key('decorate', self.description, root_keys[tree_id],
+                                          self.cache.hash_file(tax_file.path))
+                self.keys[tree_id] = key
+                if self.cache.fetch(key, self.outputs(tree_out)):
+                    continue
+            queue.append((tree_id, tree_root, tree_out, tax_file.path))
+        return queue
+
+    def done(self, tree_id):
+        """Called once a tree has been decorated to store it in the cache."""
+        if self.cache is not None:
+            tree_out = os.path.join(self.dir_root, f'{tree_id}_rooted_decorated.tree')
+            self.cache.store(self.keys[tree_id], self.outputs(tree_out))
+
+    def run(self, batchfile: Batchfile, dir_root: str, dir_dec: str, tax_file: TaxonomyFile, cpus: int,
+            root_keys=None, pool=None):
+        """Decorate each tree, largest first. A given pool must have been
+        created with TreeDecorate.worker_init."""
+        queue = self.queue(batchfile, dir_root, dir_dec, tax_file, root_keys)
+        queue.sort(key=lambda x: batchfile.tree_size(x[0]), reverse=True)
+        for _, tree_root, _, _ in queue:
             if not os.path.isfile(tree_root):
                 raise MetaTreeExit(f'Missing rooted tree: {tree_root}')
-            if not os.path.isfile(tree_out):
-                queue.append((tree_id, tree_root, tree_out, tax_file.path))
 
-        self.logger.info(f'Decorating trees using Phylorank v{phylorank_v}')
-        with Pool(processes=cpus) as pool:
-            for _ in tqdm(pool.imap_unordered(TreeDecorate.worker, queue), total=len(queue)):
-                pass
+        self.logger.info(f'Decorating trees using {self.description}')
+        with worker_pool(cpus, pool, initializer=TreeDecorate.worker_init, initargs=(tax_file,)) as pool:
+            for tree_id in tqdm(pool.imap_unordered(self.get_worker(), queue), total=len(queue)):
+                self.done(tree_id)
+
+
+class NativeDecorate(object):
+    """Decorate a rooted tree with the node of highest F-measure for each taxon.
+
+    This follows the method of `phylorank decorate --skip_rd_refine`, i.e.
+    equal placements are resolved by taking the last in a preorder traversal.
+    Each subtree is a contiguous range of the preorder, so the number of
+    genomes from a taxon below every candidate node is found with a binary
+    search over the taxon's (sorted) leaf positions.
+    """
+
+    def __init__(self, taxonomy: TaxonomyFile):
+        self.taxonomy = taxonomy
+
+    def _lineage(self, gid):
+        lineage = self.taxonomy.get_lineage(gid)
+        if lineage is None:
+            return list(RANK_PREFIXES)
+        return lineage
+
+    def run(self, tree_in, tree_out):
+        tree = dendropy.Tree.get_from_path(tree_in, schema='newick', rooting='force-rooted',
+                                           preserve_underscores=True)
+
+        # Remove any previous taxon labels.
+        for node in tree.internal_nodes():
+            support, _taxon, _aux_info = parse_label(node.label)
+            node.label = create_label(support, None, None) if support is not None else None
+
+        # Index the nodes in preorder, the subtree of node i is [i, end[i]),
+        # and the leaves below node i are [leaf_lo[i], leaf_hi[i]).
+        nodes = list(tree.preorder_node_iter())
+        node_idx = {node: i for i, node in enumerate(nodes)}
+        parent = np.full(len(nodes), -1, dtype=np.int64)
+        leaf_lo = np.zeros(len(nodes), dtype=np.int64)
+        leaves = list()
+        for i, node in enumerate(nodes):
+            if node.parent_node is not None:
+                parent[i] = node_idx[node.parent_node]
+            leaf_lo[i] = len(leaves)
+            if node.is_leaf():
+                leaves.append(node.taxon.label)
+        end = np.arange(1, len(nodes) + 1, dtype=np.int64)
+        leaf_hi = leaf_lo + 1
+        for i in range(len(nodes) - 1, 0, -1):
+            end[parent[i]] = max(end[parent[i]], end[i])
+            leaf_hi[parent[i]] = max(leaf_hi[parent[i]], leaf_hi[i])
+
+        # Index the taxonomy of the genomes in this tree.
+        lineages = [self._lineage(gid) for gid in leaves]
+        taxa_at_rank = [defaultdict(list) for _ in RANK_PREFIXES]
+        taxon_parents = dict()
+        node_named = list()
+        for rank_idx, prefix in enumerate(RANK_PREFIXES):
+            named = np.zeros(len(leaves) + 1, dtype=np.int64)
+            for leaf_idx, lineage in enumerate(lineages):
+                taxon = lineage[rank_idx]
+                if taxon != prefix:
+                    taxa_at_rank[rank_idx][taxon].append(leaf_idx)
+                    taxon_parents[taxon] = lineage[0:rank_idx]
+                    named[leaf_idx + 1] = 1
+            named = np.cumsum(named)
+            node_named.append(named[leaf_hi] - named[leaf_lo])
+
+        def n_below(positions, lo, hi):
+            return np.searchsorted(positions, hi) - np.searchsorted(positions, lo)
+
+        # Find the node(s) with the highest F-measure for each taxon.
+        placements = dict()
+        for rank_idx in range(len(RANK_PREFIXES)):
+            for taxon, positions in taxa_at_rank[rank_idx].items():
+                positions = np.array(positions, dtype=np.int64)
+
+                if rank_idx == 0:
+                    search_root = 0
+                else:
+                    # Find the first named parent taxon.
+                    parent_taxon = 'x__'
+                    parent_idx = rank_idx - 1
+                    while len(parent_taxon) == 3 and parent_idx != -1:
+                        parent_taxon = taxon_parents[taxon][parent_idx]
+                        parent_idx -= 1
+
+                    # Only the lineage below the parent needs to be searched,
+                    # unless it was not placed (e.g. a phylum in another domain).
+                    if parent_taxon not in placements:
+                        continue
+                    parent_nodes = placements[parent_taxon]
+                    search_root = parent_nodes[0]
+                    lo, hi = leaf_lo[parent_nodes].min(), leaf_hi[parent_nodes].max()
+                    while leaf_lo[search_root] > lo or leaf_hi[search_root] < hi:
+                        search_root = parent[search_root]
+
+                    # Search the entire tree if many genomes are outside of the parent.
+                    if n_below(positions, leaf_lo[search_root], leaf_hi[search_root]) < 0.5 * len(positions):
+                        search_root = 0
+
+                sub = slice(search_root, end[search_root])
+                taxa_in_lineage = n_below(positions, leaf_lo[sub], leaf_hi[sub])
+                num_leaves_with_taxa = node_named[rank_idx][sub]
+                valid = (taxa_in_lineage != 0) & (num_leaves_with_taxa != 0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    precision = taxa_in_lineage / num_leaves_with_taxa
+                    recall = taxa_in_lineage / len(positions)
+                    fmeasure = (2 * precision * recall) / (precision + recall)
+                fmeasure[~valid] = -1
+                placements[taxon] = search_root + np.flatnonzero(fmeasure == fmeasure.max())
+
+        # Resolve equal placements, and calculate the statistics for each.
+        stats = dict()
+        for rank_idx in range(len(RANK_PREFIXES)):
+            for taxon, positions in taxa_at_rank[rank_idx].items():
+                if taxon not in placements:
+                    continue
+                node = placements[taxon][-1]
+                lo, hi = leaf_lo[node], leaf_hi[node]
+                taxa_in_lineage = bisect_left(positions, hi) - bisect_left(positions, lo)
+                num_leaves_with_taxa = int(node_named[rank_idx][node])
+                precision = float(taxa_in_lineage) / num_leaves_with_taxa
+                recall = float(taxa_in_lineage) / len(positions)
+                fmeasure = (2 * precision * recall) / (precision + recall)
+                rogue_out = [leaves[x] for x in positions if not lo <= x < hi]
+                rogue_in = [leaves[x] for x in range(lo, hi)
+                            if lineages[x][rank_idx] not in {taxon, RANK_PREFIXES[rank_idx]}]
+                stats[taxon] = (node, len(positions), fmeasure, precision, recall, taxa_in_lineage,
+                                num_leaves_with_taxa, rogue_out, rogue_in)
+
+        # Place all labels on the tree.
+        taxa_sorted = sort_taxa(stats.keys())
+        for taxon in taxa_sorted:
+            node = nodes[stats[taxon][0]]
+            support, taxon_label, aux_info = parse_label(node.label)
+            taxon_label = f'{taxon_label}; {taxon}' if taxon_label else taxon
+            node.label = create_label(support, taxon_label, aux_info)
+
+        self.write_table(stats, taxa_sorted, f'{tree_out}-table')
+        self.write_summary(stats, taxa_sorted, f'{tree_out}-summary')
+        self.write_taxonomy(nodes, parent, f'{tree_out}-taxonomy')
+        tree.write_to_path(tree_out, schema='newick', suppress_rooting=True, unquoted_underscores=True)
+
+    @staticmethod
+    def write_table(stats, taxa_sorted, path):
+        with open(path, 'w') as fh:
+            fh.write('\t'.join(TABLE_COLS) + '\n')
+            for taxon in taxa_sorted:
+                _, n_expected, fmeasure, precision, recall, n_taxon, n_lineage, rogue_out, rogue_in = stats[taxon]
+                fh.write('%s\t%d\t%.4f\t%.4f\t%.4f\t%d\t%d\t%s\t%s\n' % (
+                    taxon, n_expected, fmeasure, precision, recall, n_taxon, n_lineage,
+                    ','.join(rogue_out), ','.join(rogue_in)))
+
+    @staticmethod
+    def write_summary(stats, taxa_sorted, path):
+        taxon_count = defaultdict(int)
+        mono = defaultdict(int)
+        op_mono = defaultdict(int)
+        poly = defaultdict(int)
+        for taxon in taxa_sorted:
+            rank_prefix = taxon[0:3]
+            taxon_count[rank_prefix] += 1
+            fmeasure = stats[taxon][2]
+            if fmeasure == 1.0:
+                mono[rank_prefix] += 1
+            elif fmeasure >= 0.95:
+                op_mono[rank_prefix] += 1
+            else:
+                poly[rank_prefix] += 1
+
+        with open(path, 'w') as fh:
+            fh.write('Rank\tNo. taxon\tNo. monophyletic\tNo. operationally monophyletic\tNo. polyphyletic'
+                     '\tMonophyletic (%)\tOperationally monophyletic (%)\tPolyphyletic (%)\n')
+            for rank_label, rank_prefix in zip(RANK_LABELS, RANK_PREFIXES):
+                n_taxa = taxon_count[rank_prefix]
+                if n_taxa == 0:
+                    continue
+                fh.write(f'{rank_label}\t{n_taxa}\t{mono[rank_prefix]}\t{op_mono[rank_prefix]}\t{poly[rank_prefix]}'
+                         f'\t{mono[rank_prefix] * 100.0 / n_taxa:.3f}\t{op_mono[rank_prefix] * 100.0 / n_taxa:.3f}'
+                         f'\t{poly[rank_prefix] * 100.0 / n_taxa:.3f}\n')
+
+    @staticmethod
+    def write_taxonomy(nodes, parent, path):
+        """Write the taxonomy of each leaf as decorated on the tree."""
+        node_taxa = list()
+        with open(path, 'w') as fh:
+            for i, node in enumerate(nodes):
+                taxa = list() if parent[i] == -1 else list(node_taxa[parent[i]])
+                _support, taxon, _aux_info = parse_label(node.label)
+                if taxon:
+                    taxa.extend(x.strip() for x in taxon.split(';'))
+                node_taxa.append(taxa)
+
+                if node.is_leaf():
+                    n_ranks = RANK_PREFIXES.index(taxa[-1][0:3]) + 1 if taxa else 0
+                    taxa = taxa + list(RANK_PREFIXES[n_ranks:])
+                    fh.write('%s\t%s\n' % (node.taxon.label, '; '.join(taxa)))
@@ -1,8 +1,5 @@
 import logging
 import os
-import tempfile
-from collections import defaultdict
-from multiprocessing import Pool
 from warnings import simplefilter
 
 import matplotlib.pyplot as plt
@@ -10,12 +7,17 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 from Bio import Phylo
-from Bio.Phylo.TreeConstruction import DistanceMatrix, DistanceTreeConstructor
 from scipy.cluster.hierarchy import ClusterWarning
-from tqdm import tqdm
 
+from metatree.common import worker_pool
 from metatree.external.tree_compare import TreeCompare
 from metatree.io import Batchfile, RfResults
+from metatree.io.shared_taxa import SharedTaxa
+from metatree.neighbour_joining import neighbour_joining
+from metatree.run_report import RunReport, timed_call
+from metatree.task_graph import TaskGraph
+from metatree.tree_metrics import TreeMetrics
+from metatree.tree_splits import SplitFingerprints, TreeSplits
 
 simplefilter("ignore", ClusterWarning)
 
@@ -26,38 +28,57 @@ class TreeDist(object):
         self.logger = logging.getLogger('timestamp')
 
     @staticmethod
-    def worker(task):
-        tid_a, path_a, tid_b, path_b, set_common = task
+    def worker(task, path_common=None):
+        tid_a, path_a, tid_b, path_b, common_taxa = task
 
-        if set_common:
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                taxa_list = os.path.join(tmp_dir, 'taxa_list.tsv')
-                with open(taxa_list, 'w') as fh:
-                    for taxa in set_common:
-                        fh.write(f'{taxa}\n')
+        # Calculate the RF distance, the common taxa are read once per worker (see SharedTaxa).
+        tc = TreeCompare()
+        set_common = SharedTaxa.load(path_common)[0] if common_taxa else None
+        rf, norm_rf = tc.robinson_foulds(path_a, path_b, set_common)
 
-                # Calculate the RF distance.
-                tc = TreeCompare()
-                rf, norm_rf = tc.robinson_foulds(path_a, path_b, taxa_list)
+        return tid_a, tid_b, rf, norm_rf
 
-        else:
-            # Calculate the RF distance.
-            tc = TreeCompare()
-            rf, norm_rf = tc.robinson_foulds(path_a, path_b, None)
+    @staticmethod
+    def worker_chunk(tasks, path_common=None):
+        """Calculate the RF distance of each pair in a chunk (see TreeDist.chunk_pairs)."""
+        return [TreeDist.worker(task, path_common) for task in tasks]
 
-        return tid_a, tid_b, rf, norm_rf
+    @staticmethod
+    def encode_worker(fn, path, path_taxa, *args):
+        """Encode a tree with fn, using the index of the taxa read once per worker (see SharedTaxa)."""
+        return fn(path, SharedTaxa.load(path_taxa)[1], *args)
 
-    def run(self, rf_results: RfResults, batchfile: Batchfile, dir_root, dir_dec, cpus: int, common_taxa: bool):
+    @staticmethod
+    def chunk_pairs(queue, costs, n_chunks):
+        """Group the pairs into approximately n_chunks chunks of a similar total cost.
 
-        # Determine if a common subset of taxa should be used.
-        if common_taxa:
-            set_common = batchfile.common_taxa()
-            self.logger.info(f'Robinson-Foulds metrics will only consider those {len(set_common):,} '
-                             f'taxa which are common between ALL trees.')
-        else:
-            set_common = None
+        Pairs are taken from the most to least expensive, any pair which costs
+        more than the target is a chunk on its own, and small pairs are grouped.
+        The target is the remaining cost divided by the remaining chunks.
+
+        Returns
+        -------
+        List[Tuple[List, int]]
+            Each chunk of pairs and its total cost.
+        """
+        remaining = sum(costs)
+        target = remaining / max(1, n_chunks)
+        chunks, cur, cur_cost = list(), list(), 0
+        for i in sorted(range(len(queue)), key=lambda x: costs[x], reverse=True):
+            cur.append(queue[i])
+            cur_cost += costs[i]
+            if cur_cost >= target:
+                chunks.append((cur, cur_cost))
+                remaining -= cur_cost
+                target = remaining / max(1, n_chunks - len(chunks))
+                cur, cur_cost = list(), 0
+        if len(cur) > 0:
+            chunks.append((cur, cur_cost))
+        return chunks
 
-        # Determine which trees still need to be processed.
+    @staticmethod
+    def queue(rf_results: RfResults, batchfile: Batchfile, common_taxa: bool):
+        """Return a task for each pair of trees which still need to be processed."""
         queue = list()
         tree_ids = list(batchfile.data.keys())
         for i in range(len(tree_ids)):
@@ -67,68 +88,169 @@ class TreeDist(object):
                 tid_b = tree_ids[j]
                 path_b = batchfile.data[tid_b]
                 if not rf_results.is_done(tid_a, tid_b):
-                    queue.append((tid_a, path_a, tid_b, path_b, set_common))
+                    queue.append((tid_a, path_a, tid_b, path_b, common_taxa))
+        return queue
+
+    def add_tasks(self, graph: TaskGraph, rf_results: RfResults, batchfile: Batchfile, common_taxa: bool,
+                  method: str, set_common, dir_shared, cpus: int, priority: int = 0, pool=None):
+        """Add the tasks required to calculate each outstanding pair to the graph.
+
+        Each task is given its estimated cost, the size of the tree (or the
+        product of the sizes for a pair) so that the largest are started first.
+        The taxa used by the workers are written to dir_shared (see SharedTaxa).
+        """
+        queue = self.queue(rf_results, batchfile, common_taxa)
+        mode = 'common' if common_taxa else 'all'
+
+        if method == 'pairwise':
+            # Small pairs are grouped, so there are a few chunks per worker.
+            costs = [batchfile.tree_size(tid_a) * batchfile.tree_size(tid_b) for tid_a, _, tid_b, _, _ in queue]
+            path_common = SharedTaxa(dir_shared, set_common).path if common_taxa and queue else None
+            for i, (chunk, cost) in enumerate(self.chunk_pairs(queue, costs, cpus * 4)):
+                graph.add(('rf', mode, i), TreeDist.worker_chunk, (chunk, path_common),
+                          callback=lambda r: [rf_results.add(*x) for x in r], priority=priority, cost=cost)
+            return
+
+        # Otherwise, parse and encode each tree once (as bitmasks, or fingerprints).
+        cls = SplitFingerprints if method == 'fingerprint' else TreeSplits
+        splits = cls(set_common if common_taxa else batchfile.all_taxa(cpus, pool))
+        tree_ids = sorted({tid for tid_a, _, tid_b, _, _ in queue for tid in (tid_a, tid_b)})
+        path_taxa = SharedTaxa(dir_shared, splits.taxa).path if tree_ids else None
+        for tree_id in tree_ids:
+            if tree_id in batchfile.parsed:
+                fn, path = cls.encode_parsed, batchfile.parsed[tree_id]
+            else:
+                fn, path = cls.encode, batchfile.data[tree_id]
+            graph.add(('splits', mode, tree_id), TreeDist.encode_worker, (fn, path, path_taxa),
+                      callback=lambda r, tid=tree_id: splits.add(tid, *r), priority=priority,
+                      cost=batchfile.tree_size(tree_id))
+
+        if method == 'cached':
+            for tid_a, _, tid_b, _, _ in queue:
+                graph.add(('rf', mode, tid_a, tid_b), TreeDist.compare_cached, (rf_results, splits, tid_a, tid_b),
+                          deps=[('splits', mode, tid_a), ('splits', mode, tid_b)], priority=priority, local=True)
+        else:
+            graph.add(('rf', mode), TreeDist.compare_matrix, (rf_results, splits, queue),
+                      deps=[('splits', mode, x) for x in tree_ids], priority=priority, local=True)
+
+    @staticmethod
+    def compare_cached(rf_results: RfResults, splits: TreeSplits, tid_a, tid_b):
+        """Compare a pair of trees using their cached splits."""
+        rf, norm_rf = splits.robinson_foulds(tid_a, tid_b)
+        rf_results.add(tid_a, tid_b, rf, norm_rf)
+
+    @staticmethod
+    def compare_matrix(rf_results: RfResults, splits: TreeSplits, queue):
+        """Compare all trees in a single step."""
+        tree_ids = sorted(splits.splits)
+        tree_idx = {tid: i for i, tid in enumerate(tree_ids)}
+        mat_rf, mat_norm_rf = splits.rf_matrix(tree_ids)
+        for tid_a, _, tid_b, _, _ in queue:
+            i, j = tree_idx[tid_a], tree_idx[tid_b]
+            rf_results.add(tid_a, tid_b, int(mat_rf[i, j]), float(mat_norm_rf[i, j]))
+
+    def add_metric_tasks(self, graph: TaskGraph, results, batchfile: Batchfile, common_taxa: bool, set_common,
+                         dir_shared, cpus: int, min_support: float = 50.0, max_depth: float = 1.0,
+                         priority: int = 0, pool=None):
+        """Add the tasks required to calculate several metrics for each outstanding pair to the graph.
+
+        Each tree is encoded once, and every metric for a pair is calculated
+        at the same time (see TreeMetrics). results maps each metric to the
+        RfResults it is written to, a pair is compared if any are missing it.
+        The taxa used by the workers are written to dir_shared (see SharedTaxa).
+        """
+        queue = list()
+        tree_ids = list(batchfile.data.keys())
+        for i in range(len(tree_ids)):
+            for j in range(i):
+                if not all(x.is_done(tree_ids[i], tree_ids[j]) for x in results.values()):
+                    queue.append((tree_ids[i], tree_ids[j]))
+        mode = 'common' if common_taxa else 'all'
+
+        metrics = TreeMetrics(set_common if common_taxa else batchfile.all_taxa(cpus, pool), results,
+                              min_support, max_depth)
+        tree_ids = sorted({tid for pair in queue for tid in pair})
+        path_taxa = SharedTaxa(dir_shared, metrics.taxa).path if tree_ids else None
+        for tree_id in tree_ids:
+            parsed = tree_id in batchfile.parsed
+            path = batchfile.parsed[tree_id] if parsed else batchfile.data[tree_id]
+            graph.add(('edges', mode, tree_id), TreeDist.encode_worker,
+                      (TreeMetrics.encode, path, path_taxa, min_support, max_depth, parsed),
+                      callback=lambda r, tid=tree_id: metrics.add(tid, *r), priority=priority,
+                      cost=batchfile.tree_size(tree_id))
+        graph.add(('metrics', mode), TreeDist.compare_metrics, (results, metrics, queue),
+                  deps=[('edges', mode, x) for x in tree_ids], priority=priority, local=True)
+
+    @staticmethod
+    def compare_metrics(results, metrics: TreeMetrics, queue):
+        """Calculate every metric for each pair of encoded trees."""
+        for tid_a, tid_b in queue:
+            for metric, values in metrics.compare(tid_a, tid_b).items():
+                if not results[metric].is_done(tid_a, tid_b):
+                    results[metric].add(tid_a, tid_b, *values)
+
+    def run(self, rf_results: RfResults, batchfile: Batchfile, dir_root, dir_dec, cpus: int, common_taxa: bool,
+            method: str = 'pairwise', pool=None):
+
+        # Determine if a common subset of taxa should be used.
+        if common_taxa:
+            set_common = batchfile.common_taxa(cpus, pool)
+            self.logger.info(f'Robinson-Foulds metrics will only consider those {len(set_common):,} '
+                             f'taxa which are common between ALL trees.')
+        else:
+            set_common = None
+
+        graph = TaskGraph()
+        self.add_tasks(graph, rf_results, batchfile, common_taxa, method, set_common, dir_root, cpus, pool=pool)
 
         self.logger.info(f'Calculating Robinson-Foulds distances.')
-        with Pool(processes=cpus) as pool:
-            for tid_a, tid_b, rf, norm_rf in tqdm(pool.imap_unordered(TreeDist.worker, queue), total=len(queue)):
-                rf_results.add(tid_a, tid_b, rf, norm_rf)
+        graph.run(cpus, pool=pool)
 
         rf_results.write()
 
-    def summarise_dist(self, rf_results: RfResults, dir_out):
+    def summary_tasks(self, rf_results: RfResults, dir_out, annot_max=50, prefix='rf', name='Robinson-Foulds'):
+        """Return a task for the normalised and un-normalised NJ tree and heatmap,
+        the values are only annotated if there are at most annot_max trees."""
+        labels, mat_rf, mat_norm_rf = rf_results.to_matrix()
+        annot = len(labels) <= annot_max
+        if not annot:
+            self.logger.info(f'Not annotating the heatmaps in {dir_out} as there are more than '
+                             f'{annot_max:,} trees.')
+        return [(labels, mat_norm_rf, os.path.join(dir_out, f'{prefix}_normed.tree'),
+                 os.path.join(dir_out, f'{prefix}_normed_heatmap.svg'), f'Normalised {name} Distance', annot),
+                (labels, mat_rf, os.path.join(dir_out, f'{prefix}_un_normed.tree'),
+                 os.path.join(dir_out, f'{prefix}_un_normed_heatmap.svg'), f'(un)Normalised {name} Distance', annot)]
+
+    @staticmethod
+    def summary_worker(labels, mat, path_out, path_hm, plt_title, annot):
+
+        # Newick
+        tree = neighbour_joining(labels, mat)
+        Phylo.write(tree, path_out, 'newick')
+
+        # Heatmap
+        cmap = sns.cubehelix_palette(100, reverse=True)
+
+        sns.set(font_scale=1)
+        fig_size = (15, 15)
 
-        for use_norm in (True, False):
-            if use_norm:
-                path_out = os.path.join(dir_out, 'rf_normed.tree')
-                path_hm = os.path.join(dir_out, 'rf_normed_heatmap.svg')
-                plt_title = 'Normalised Robinson-Foulds Distance'
+        rf_df = pd.DataFrame(mat, columns=labels, index=labels)
+        grid = sns.clustermap(rf_df, annot=annot, fmt='.3f', cmap=cmap, figsize=fig_size)
+        grid.fig.suptitle(plt_title)
+        grid.fig.savefig(path_hm)
+        plt.close(grid.fig)
+
+    def summarise_dist(self, rf_results: RfResults, dir_out, annot_max=50):
+        for task in self.summary_tasks(rf_results, dir_out, annot_max):
+            TreeDist.summary_worker(*task)
+
+    @staticmethod
+    def summarise_many(tasks, cpus, report: RunReport = None, pool=None):
+        """Run each task from TreeDist.summary_tasks concurrently."""
+        with worker_pool(max(1, min(cpus, len(tasks))), pool) as pool:
+            if report is None:
+                pool.starmap(TreeDist.summary_worker, tasks)
             else:
-                path_out = os.path.join(dir_out, 'rf_un_normed.tree')
-                path_hm = os.path.join(dir_out, 'rf_un_normed_heatmap.svg')
-                plt_title = '(un)Normalised Robinson-Foulds Distance'
-
-            metrics = defaultdict(dict)
-            names = set()
-            for (tid_a, tid_b), (rf, norm_rf) in rf_results.data.items():
-                if use_norm:
-                    metrics[tid_a][tid_b] = norm_rf
-                    metrics[tid_b][tid_a] = norm_rf
-                else:
-                    metrics[tid_a][tid_b] = rf
-                    metrics[tid_b][tid_a] = rf
-                names.add(tid_a)
-                names.add(tid_b)
-
-            labels = sorted(list(names))
-            mat_vals = list()
-            mat = np.zeros((len(labels), len(labels)))
-            for i in range(len(labels)):
-                cur_row = list()
-                tid_a = labels[i]
-                for j in range(i + 1):
-                    tid_b = labels[j]
-                    if tid_a == tid_b:
-                        cur_row.append(0.0)
-                    else:
-                        cur_row.append(metrics[tid_a][tid_b])
-                        mat[i, j] = metrics[tid_a][tid_b]
-                mat_vals.append(cur_row)
-            mat = mat + mat.T
-
-            # Newick
-            dm = DistanceMatrix(names=labels, matrix=mat_vals)
-            constructor = DistanceTreeConstructor()
-            tree = constructor.nj(dm)
-
-            Phylo.write(tree, path_out, 'newick')
-
-            # Heatmap
-            cmap = sns.cubehelix_palette(100, reverse=True)
-
-            sns.set(font_scale=1)
-            fig_size = (15, 15)
-
-            rf_df = pd.DataFrame(mat, columns=labels, index=labels)
-            sns.clustermap(rf_df, annot=True, fmt='.3f', cmap=cmap, figsize=fig_size).fig.suptitle(plt_title)
-            plt.savefig(path_hm)
+                results = pool.starmap(timed_call, [(TreeDist.summary_worker, x) for x in tasks])
+                for task, (_, stats) in zip(tasks, results):
+                    report.add_task(os.path.basename(task[3]), 'summarise_dist', stats)
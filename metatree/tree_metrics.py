@@ -0,0 +1,327 @@
+import logging
+import math
+
+import numpy as np
+
+from metatree.exception import MetaTreeExit
+from metatree.io.parsed_tree import ParsedTree
+from metatree.tree_splits import check_rf_taxa
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(x):
+        return bin(x).count('1')
+
+# The directory, file prefix, and name of the results of each metric.
+METRICS = {'rf': ('robinson_foulds', 'rf', 'Robinson-Foulds'),
+           'weighted_rf': ('weighted_robinson_foulds', 'wrf', 'Weighted Robinson-Foulds'),
+           'euclidean': ('euclidean', 'euclidean', 'Euclidean'),
+           'supported_splits': ('supported_splits', 'ss', 'Supported Splits')}
+
+
+def _add_length(a, b):
+    """Add two (possibly missing) branch lengths, as dendropy does when suppressing a node."""
+    if math.isnan(b):
+        return a
+    if math.isnan(a):
+        return b
+    return a + b
+
+
+class TreeEdges(object):
+    """A tree restricted to a set of taxa, stored as lists in preorder.
+
+    parent[i] is the parent of node i (-1 for the root), taxon[i] is the
+    index of the taxon of a leaf (-1 for internal nodes), length[i] is the
+    length of the edge above node i, and support[i] the support value of an
+    internal node (both are NaN if absent).
+    """
+    __slots__ = ('parent', 'taxon', 'length', 'support')
+
+    def __init__(self, parent, taxon, length, support):
+        self.parent = parent
+        self.taxon = taxon
+        self.length = length
+        self.support = support
+
+    @staticmethod
+    def from_parsed(tree: ParsedTree, taxa_idx):
+        """Create the edges from a parsed tree, pruning the leaves which are not in taxa_idx.
+
+        Fractional support values (i.e. all are <= 1) are scaled to [0, 100].
+        """
+        support = np.array(tree.support, dtype=np.float64)
+        if not np.any(support > 1.0):
+            support = np.floor(support * 100 + 0.5)
+        label_taxon = [taxa_idx.get(x, -1) for x in tree.labels]
+        taxon = [label_taxon[x] if x >= 0 else -1 for x in tree.leaf.tolist()]
+        keep = [x >= 0 for x in taxon]
+        edges = TreeEdges(tree.parent.tolist(), taxon, tree.length.tolist(), support.tolist())
+        return edges.prune(keep)
+
+    def prune(self, keep):
+        """Return a copy of the tree without the leaves where keep[i] is False.
+
+        As in dendropy, internal nodes without any remaining leaves are
+        removed, and nodes with a single child are suppressed (adding the
+        length of their edge to that of their child).
+        """
+        n = len(self.parent)
+        n_kept = [0] * n
+        n_children = [0] * n
+        for i in range(n - 1, -1, -1):
+            if self.taxon[i] >= 0 and keep[i]:
+                n_kept[i] = 1
+            p = self.parent[i]
+            if p >= 0 and n_kept[i] > 0:
+                n_kept[p] += n_kept[i]
+                n_children[p] += 1
+        if n_kept[0] == 0:
+            raise MetaTreeExit('No taxa remain in the tree after pruning.')
+
+        # Each node that remains is attached to its closest remaining ancestor.
+        new_idx = [-1] * n
+        parent, taxon, length, support = list(), list(), list(), list()
+        for i in range(n):
+            if n_kept[i] == 0 or (self.taxon[i] < 0 and n_children[i] == 1):
+                continue
+            cur_length = self.length[i]
+            p = self.parent[i]
+            while p >= 0 and new_idx[p] < 0:
+                cur_length = _add_length(cur_length, self.length[p])
+                p = self.parent[p]
+            new_idx[i] = len(parent)
+            parent.append(new_idx[p] if p >= 0 else -1)
+            taxon.append(self.taxon[i])
+            length.append(cur_length)
+            support.append(self.support[i])
+        return TreeEdges(parent, taxon, length, support)
+
+    def collapse_basal_bifurcation(self):
+        """Return a copy of the tree with a degree-2 root converted to a
+        degree-3 node, as done by dendropy when encoding an unrooted tree."""
+        children = [i for i, p in enumerate(self.parent) if p == 0]
+        if len(children) != 2:
+            return self
+        is_internal = [self.taxon[x] < 0 and self.parent.count(x) >= 2 for x in children]
+        if is_internal[1]:
+            to_keep, to_del = children
+        elif is_internal[0]:
+            to_del, to_keep = children
+        else:
+            return self
+
+        length = list(self.length)
+        if not math.isnan(length[to_keep]) and not math.isnan(length[to_del]):
+            length[to_keep] += length[to_del]
+        new_idx = [i if i < to_del else i - 1 for i in range(len(self.parent))]
+        new_idx[to_del] = 0
+        keep = [i for i in range(len(self.parent)) if i != to_del]
+        return TreeEdges([new_idx[self.parent[i]] if self.parent[i] >= 0 else -1 for i in keep],
+                         [self.taxon[i] for i in keep],
+                         [length[i] for i in keep],
+                         [self.support[i] for i in keep])
+
+    def rel_dist(self):
+        """Return the relative distance of each node between the root (0) and
+        the leaves (1), as calculated by TreeCompare._rel_dist."""
+        n = len(self.parent)
+        length = [0.0 if math.isnan(x) else x for x in self.length]
+        children = [list() for _ in range(n)]
+        for i in range(1, n):
+            children[self.parent[i]].append(i)
+
+        num_taxa = [0] * n
+        mean_dist = [0.0] * n
+        for i in range(n - 1, -1, -1):
+            if not children[i]:
+                num_taxa[i] = 1
+                continue
+            num_taxa[i] = sum(num_taxa[c] for c in children[i])
+            avg_div = 0
+            for c in children[i]:
+                avg_div += (float(num_taxa[c]) / num_taxa[i]) * (mean_dist[c] + length[c])
+            mean_dist[i] = avg_div
+
+        out = [0.0] * n
+        for i in range(1, n):
+            if not children[i]:
+                out[i] = 1.0
+                continue
+            a, b, x = length[i], mean_dist[i], out[self.parent[i]]
+            out[i] = x + (a / (a + b)) * (1.0 - x) if (a + b) != 0 else x
+        return out
+
+    def table(self, min_support, max_depth):
+        """Return the edge table of the (unrooted) tree, see EdgeTable."""
+        tree = self.collapse_basal_bifurcation()
+        n = len(tree.parent)
+        masks = [0] * n
+        is_leaf = [True] * n
+        for i in range(n - 1, -1, -1):
+            if tree.taxon[i] >= 0:
+                masks[i] = 1 << tree.taxon[i]
+            p = tree.parent[i]
+            if p >= 0:
+                masks[p] |= masks[i]
+                is_leaf[p] = False
+
+        # Each split is expressed as the side without the lowest taxon (the root edge is 0).
+        leaves = masks[0]
+        low = leaves & -leaves
+        n_taxa = _popcount(leaves)
+        rel_dist = tree.rel_dist()
+        edges = dict()
+        for i in range(n):
+            split = masks[i] ^ leaves if masks[i] & low else masks[i]
+            n_split = _popcount(split)
+            supported = False
+            if not is_leaf[i] and i > 0:
+                support = tree.support[i]
+                supported = math.isnan(support) or (support >= min_support and rel_dist[i] <= max_depth)
+            length = 0.0 if math.isnan(tree.length[i]) else tree.length[i]
+            edges[split] = (length, 2 <= n_split <= n_taxa - 2, supported)
+
+        values = list(edges.values())
+        return EdgeTable(leaves, n_taxa, list(edges),
+                         np.array([x[0] for x in values], dtype=np.float64),
+                         np.array([x[1] for x in values], dtype=bool),
+                         np.array([x[2] for x in values], dtype=bool))
+
+
+class EdgeTable(object):
+    """The split, length, and flags of each edge in an unrooted tree.
+
+    Splits are bitmasks over the taxon index, until TreeMetrics assigns each
+    unique split an integer id (ids), at which point the table is sorted.
+    An edge is supported if it is a non-trivial internal edge, and it is
+    either unlabelled or has at least the minimum support and a relative
+    distance from the root of at most the maximum depth (TreeCompare.supported_splits).
+    """
+    __slots__ = ('leaves', 'n_taxa', 'splits', 'ids', 'length', 'nontrivial', 'supported')
+
+    def __init__(self, leaves, n_taxa, splits, length, nontrivial, supported):
+        self.leaves = leaves
+        self.n_taxa = n_taxa
+        self.splits = splits
+        self.ids = None
+        self.length = length
+        self.nontrivial = nontrivial
+        self.supported = supported
+
+    def index(self, split_idx):
+        """Assign an id to each split (adding new splits to split_idx), and sort the edges by id."""
+        ids = np.array([split_idx.setdefault(x, len(split_idx)) for x in self.splits], dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        self.ids = ids[order]
+        self.length = self.length[order]
+        self.nontrivial = self.nontrivial[order]
+        self.supported = self.supported[order]
+        self.splits = None
+        return self
+
+
+def compare_tables(table_a: EdgeTable, table_b: EdgeTable, metrics):
+    """Calculate each metric between two indexed edge tables over the same taxa.
+
+    The edges of both trees are matched once, and every metric is calculated
+    from the matched and unmatched edges. Each metric is returned as an
+    un-normalised and normalised (0 is identical) value:
+
+    - rf: the Robinson-Foulds distance, normalised by 2(n - 3).
+    - weighted_rf: the sum of the difference in length of each edge (0 if
+      absent), normalised by the total length of both trees.
+    - euclidean: the square root of the sum of the squared difference in
+      length of each edge, normalised by the same over both trees.
+    - supported_splits: the number of supported splits in either tree which
+      are absent from the other, and one minus the fraction (by length) of
+      the supported splits in both trees which are supported in both.
+    """
+    _, idx_a, idx_b = np.intersect1d(table_a.ids, table_b.ids, assume_unique=True, return_indices=True)
+    only_a = np.ones(len(table_a.ids), dtype=bool)
+    only_a[idx_a] = False
+    only_b = np.ones(len(table_b.ids), dtype=bool)
+    only_b[idx_b] = False
+    len_a, len_b = table_a.length, table_b.length
+    diff = len_a[idx_a] - len_b[idx_b]
+
+    out = dict()
+    if 'rf' in metrics:
+        rf = int(table_a.nontrivial.sum() + table_b.nontrivial.sum() - 2 * table_a.nontrivial[idx_a].sum())
+        out['rf'] = (rf, float(rf) / (2 * (table_a.n_taxa - 3)))
+
+    if 'weighted_rf' in metrics:
+        wrf = float(np.abs(diff).sum() + len_a[only_a].sum() + len_b[only_b].sum())
+        total = float(len_a.sum() + len_b.sum())
+        out['weighted_rf'] = (wrf, wrf / total if total > 0 else 0.0)
+
+    if 'euclidean' in metrics:
+        sq = float(np.square(diff).sum() + np.square(len_a[only_a]).sum() + np.square(len_b[only_b]).sum())
+        total = float(np.square(len_a).sum() + np.square(len_b).sum())
+        out['euclidean'] = (math.sqrt(sq), math.sqrt(sq / total) if total > 0 else 0.0)
+
+    if 'supported_splits' in metrics:
+        sup_a, sup_b = table_a.supported, table_b.supported
+        common = sup_a[idx_a] & sup_b[idx_b]
+        common_w = float((len_a[idx_a][common] + len_b[idx_b][common]).sum())
+        total_w = float(len_a[sup_a].sum() + len_b[sup_b].sum())
+        n_absent = int(sup_a.sum() - sup_a[idx_a].sum() + sup_b.sum() - sup_b[idx_b].sum())
+        out['supported_splits'] = (n_absent, 1.0 - common_w / total_w if total_w > 0 else 0.0)
+
+    return out
+
+
+class TreeMetrics(object):
+    """Several distance metrics between a set of trees, each tree is parsed
+    and encoded once, and all metrics for a pair are calculated in a single
+    pass over their edges (see compare_tables).
+
+    Pairs of trees over a different set of taxa are pruned to their common
+    taxa before being compared, as done by TreeCompare.
+    """
+
+    def __init__(self, taxa, metrics, min_support=50.0, max_depth=1.0):
+        self.logger = logging.getLogger('timestamp')
+        self.taxa = sorted(taxa)
+        self.taxa_idx = {x: i for i, x in enumerate(self.taxa)}
+        self.metrics = tuple(metrics)
+        self.min_support = min_support
+        self.max_depth = max_depth
+        self.edges = dict()
+        self.tables = dict()
+        self.split_idx = dict()
+
+    @staticmethod
+    def encode(path, taxa_idx, min_support, max_depth, parsed=True):
+        """Read a tree (written by ParsedTree.write if parsed, otherwise Newick)
+        and return its edges and edge table."""
+        tree = ParsedTree.load(path) if parsed else ParsedTree.from_newick(path)
+        edges = TreeEdges.from_parsed(tree, taxa_idx)
+        return edges, edges.table(min_support, max_depth)
+
+    def add(self, tree_id, edges, table):
+        """Store an encoded tree, see TreeMetrics.encode."""
+        self.edges[tree_id] = edges
+        self.tables[tree_id] = table.index(self.split_idx)
+
+    def compare(self, tid_a, tid_b):
+        """Return the un-normalised and normalised value of each metric between two encoded trees."""
+        table_a, table_b = self.tables[tid_a], self.tables[tid_b]
+        if table_a.leaves != table_b.leaves:
+            leaves = table_a.leaves & table_b.leaves
+            if not leaves:
+                raise MetaTreeExit(f'No taxa in common between {tid_a} and {tid_b}.')
+
+            # The splits of the pruned trees are only needed for this pair.
+            split_idx = dict()
+            tables = list()
+            for tree_id in (tid_a, tid_b):
+                edges = self.edges[tree_id]
+                keep = [x >= 0 and (leaves >> x) & 1 == 1 for x in edges.taxon]
+                table = edges.prune(keep).table(self.min_support, self.max_depth)
+                tables.append(table.index(split_idx))
+            table_a, table_b = tables
+        if 'rf' in self.metrics:
+            check_rf_taxa(table_a.n_taxa, f'common between {tid_a} and {tid_b}')
+        return compare_tables(table_a, table_b, self.metrics)
@@ -1,23 +1,31 @@
 import logging
 import os
 import subprocess
-from multiprocessing import Pool
 
 from genometreetk import __version__ as genometreetk_v
 from tqdm import tqdm
 
-from metatree.common import make_sure_path_exists
+from metatree.cache import ArtifactCache
+from metatree.common import make_sure_path_exists, worker_pool
 from metatree.exception import MetaTreeExit
+from metatree.external.reroot_tree import RerootTree
 from metatree.io import Batchfile
 from metatree.io.taxonomy_file import TaxonomyFile
 
 
 class TreeRoot(object):
 
-    def __init__(self, dir_root):
+    def __init__(self, dir_root, engine='native', cache: ArtifactCache = None):
         self.dir_root = dir_root
+        self.engine = engine
+        self.cache = cache
+        self.keys = dict()
         self.logger = logging.getLogger('timestamp')
         make_sure_path_exists(dir_root)
+        if engine == 'native':
+            self.description = f'in-process rooting (GenomeTreeTk v{genometreetk_v} method)'
+        else:
+            self.description = f'GenomeTreeTk v{genometreetk_v}'
 
     @staticmethod
     def worker(task):
@@ -27,15 +35,49 @@ class TreeRoot(object):
         proc.communicate()
         if not proc.returncode == 0:
             raise MetaTreeExit(f'Non-zero return code: {" ".join(args)}')
+        return tree_id
 
-    def run(self, batchfile: Batchfile, dir_root: str, outgroup: str, tax_file: TaxonomyFile, cpus: int):
+    @staticmethod
+    def worker_native(task):
+        tree_id, tree_in, tree_out, outgroup_gids = task
+        RerootTree().root_with_outgroup(tree_in, tree_out, outgroup_gids)
+        return tree_id
+
+    def get_worker(self):
+        return TreeRoot.worker_native if self.engine == 'native' else TreeRoot.worker
+
+    def queue(self, batchfile: Batchfile, dir_root: str, outgroup: str, tax_file: TaxonomyFile):
+        """Return a task for each tree which has not yet been rooted."""
         queue = list()
+        outgroup_gids = tax_file.genomes_in_taxon(outgroup) if self.engine == 'native' else None
         for tree_id, tree_in in batchfile.data.items():
             tree_out = os.path.join(dir_root, f'{tree_id}_rooted.tree')
-            if not os.path.isfile(tree_out):
+            if self.cache is None:
+                if os.path.isfile(tree_out):
+                    continue
+            else:
+                key = self.cache.make_key('root', self.description, self.cache.hash_file(tree_in),
+                                          self.cache.hash_file(tax_file.path), outgroup)
+                self.keys[tree_id] = key
+                if self.cache.fetch(key, [tree_out]):
+                    continue
+            if self.engine == 'native':
+                queue.append((tree_id, tree_in, tree_out, outgroup_gids))
+            else:
                 queue.append((tree_id, tree_in, tree_out, outgroup, tax_file.path))
+        return queue
+
+    def done(self, tree_id):
+        """Called once a tree has been rooted to store it in the cache."""
+        if self.cache is not None:
+            self.cache.store(self.keys[tree_id], [os.path.join(self.dir_root, f'{tree_id}_rooted.tree')])
+
+    def run(self, batchfile: Batchfile, dir_root: str, outgroup: str, tax_file: TaxonomyFile, cpus: int,
+            pool=None):
+        queue = self.queue(batchfile, dir_root, outgroup, tax_file)
+        queue.sort(key=lambda x: batchfile.tree_size(x[0]), reverse=True)
 
-        self.logger.info(f'Rooting trees using GenomeTreeTk v{genometreetk_v}')
-        with Pool(processes=cpus) as pool:
-            for _ in tqdm(pool.imap_unordered(TreeRoot.worker, queue), total=len(queue)):
-                pass
+        self.logger.info(f'Rooting trees using {self.description}')
+        with worker_pool(cpus, pool) as pool:
+            for tree_id in tqdm(pool.imap_unordered(self.get_worker(), queue), total=len(queue)):
+                self.done(tree_id)
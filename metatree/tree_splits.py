@@ -0,0 +1,300 @@
+import hashlib
+import logging
+
+import dendropy
+import numpy as np
+from scipy import sparse
+
+from metatree.exception import MetaTreeExit
+from metatree.io.parsed_tree import ParsedTree
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(x):
+        return bin(x).count('1')
+
+
+def check_rf_taxa(n_taxa, desc):
+    """Raise an exception if the normalised Robinson-Foulds distance, i.e. RF / 2(n - 3), is undefined."""
+    if n_taxa <= 3:
+        raise MetaTreeExit(f'At least 4 taxa are required to calculate a normalised Robinson-Foulds '
+                           f'distance, there are {n_taxa:,} in {desc}.')
+
+
+class TreeSplits(object):
+    """Non-trivial splits of a set of trees, each tree is parsed and encoded
+    once as bitmasks over a shared taxon index."""
+
+    def __init__(self, taxa):
+        self.logger = logging.getLogger('timestamp')
+        self.taxa = sorted(taxa)
+        self.taxa_idx = {x: i for i, x in enumerate(self.taxa)}
+        self.leaves = dict()
+        self.splits = dict()
+
+    @staticmethod
+    def canonical(splits, leaves):
+        """Express each split as the side without the lowest taxon in leaves,
+        discarding those which are trivial over leaves."""
+        low = leaves & -leaves
+        n_leaves = _popcount(leaves)
+        out = set()
+        for split in splits:
+            split &= leaves
+            if split & low:
+                split ^= leaves
+            if 2 <= _popcount(split) <= n_leaves - 2:
+                out.add(split)
+        return frozenset(out)
+
+    @staticmethod
+    def encode(path, taxa_idx):
+        """Read a tree and return the bitmask of its taxa and its splits."""
+        tree = dendropy.Tree.get_from_path(path, schema='newick', rooting='force-unrooted',
+                                           preserve_underscores=True)
+        masks = dict()
+        clades = list()
+        for node in tree.postorder_node_iter():
+            if node.is_leaf():
+                idx = taxa_idx.get(node.taxon.label)
+                mask = 0 if idx is None else 1 << idx
+            else:
+                mask = 0
+                for child in node.child_node_iter():
+                    mask |= masks.pop(child)
+                clades.append(mask)
+            masks[node] = mask
+        leaves = masks[tree.seed_node]
+        return leaves, TreeSplits.canonical(clades, leaves)
+
+    @staticmethod
+    def encode_parsed(path, taxa_idx):
+        """As TreeSplits.encode, but for a tree written by ParsedTree.write."""
+        tree = ParsedTree.load(path)
+        label_masks = [1 << taxa_idx[x] if x in taxa_idx else 0 for x in tree.labels]
+        parent, leaf = tree.parent.tolist(), tree.leaf.tolist()
+
+        # Descendants always follow their ancestors in preorder.
+        masks = [0] * len(parent)
+        clades = list()
+        for i in range(len(parent) - 1, -1, -1):
+            if leaf[i] >= 0:
+                masks[i] = label_masks[leaf[i]]
+            else:
+                clades.append(masks[i])
+            if parent[i] >= 0:
+                masks[parent[i]] |= masks[i]
+        return masks[0], TreeSplits.canonical(clades, masks[0])
+
+    def add(self, tree_id, leaves, splits):
+        """Store the encoded splits of a tree, see TreeSplits.encode."""
+        self.leaves[tree_id] = leaves
+        self.splits[tree_id] = splits
+
+    def robinson_foulds(self, tid_a, tid_b):
+        """Calculate the Robinson-Foulds distance between two encoded trees,
+        pruning both to their common taxa if required."""
+        leaves = self.leaves[tid_a]
+        splits_a, splits_b = self.splits[tid_a], self.splits[tid_b]
+        if leaves != self.leaves[tid_b]:
+            leaves &= self.leaves[tid_b]
+            if not leaves:
+                raise MetaTreeExit(f'No taxa in common between {tid_a} and {tid_b}.')
+            splits_a = TreeSplits.canonical(splits_a, leaves)
+            splits_b = TreeSplits.canonical(splits_b, leaves)
+
+        num_taxa = _popcount(leaves)
+        check_rf_taxa(num_taxa, f'common between {tid_a} and {tid_b}')
+        rf = len(splits_a.symmetric_difference(splits_b))
+        normalized_rf = float(rf) / (2 * (num_taxa - 3))
+
+        return rf, normalized_rf
+
+    def rf_matrix(self, tree_ids):
+        """Calculate the Robinson-Foulds distance between all encoded trees.
+
+        Every unique split is assigned a column in a sparse tree x split
+        incidence matrix, the number of shared splits for all pairs is then
+        a single matrix product, i.e. RF = |A| + |B| - 2|A n B|. Pairs of
+        trees that are not defined over the same taxa are pruned and
+        compared individually.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The un-normalised and normalised distance matrices, ordered by tree_ids.
+        """
+        n_taxa = [_popcount(self.leaves[x]) for x in tree_ids]
+        for tree_id, n in zip(tree_ids, n_taxa):
+            check_rf_taxa(n, f'tree {tree_id}')
+
+        split_idx = dict()
+        rows, cols = list(), list()
+        for i, tree_id in enumerate(tree_ids):
+            for split in self.splits[tree_id]:
+                rows.append(i)
+                cols.append(split_idx.setdefault(split, len(split_idx)))
+        incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                      shape=(len(tree_ids), len(split_idx)))
+
+        shared = (incidence @ incidence.T).toarray()
+        n_splits = np.diag(shared)
+        rf = n_splits[:, None] + n_splits[None, :] - 2 * shared
+
+        norm_rf = rf / (2 * (np.array(n_taxa, dtype=np.float64)[:, None] - 3))
+        np.fill_diagonal(norm_rf, 0.0)
+
+        # Pairs of trees over a different set of taxa need to be pruned.
+        for i in range(len(tree_ids)):
+            for j in range(i):
+                if self.leaves[tree_ids[i]] != self.leaves[tree_ids[j]]:
+                    rf[i, j], norm_rf[i, j] = self.robinson_foulds(tree_ids[i], tree_ids[j])
+                    rf[j, i], norm_rf[j, i] = rf[i, j], norm_rf[i, j]
+
+        return rf, norm_rf
+
+
+def _taxon_value(label):
+    """Return the pseudo-random 128-bit value of a taxon (independent of any other taxa)."""
+    return int.from_bytes(hashlib.blake2b(label.encode('utf-8'), digest_size=16).digest(), 'little')
+
+
+class SplitFingerprints(object):
+    """Non-trivial splits of a set of trees, stored as fingerprints in O(n)
+    memory per tree (the bitmasks of TreeSplits take O(n) bits per split).
+
+    Each taxon has a pseudo-random 128-bit value, a split is the XOR of the
+    values on one side (the smaller of it and its complement) along with the
+    number of taxa on that side. Two different splits have the same
+    fingerprint with negligible probability, a collision is only missed if
+    both splits also have the same size (see SplitFingerprints.check).
+    """
+
+    def __init__(self, taxa):
+        self.logger = logging.getLogger('timestamp')
+        self.taxa = sorted(taxa)
+        self.taxa_idx = {x: i for i, x in enumerate(self.taxa)}
+        self.trees = dict()
+        self.splits = dict()
+
+    @staticmethod
+    def fingerprints(parent, values, sizes):
+        """Return the unique non-trivial splits of a tree as an (n x 3) uint64
+        array of the high and low 64 bits of the fingerprint, and the size.
+
+        Nodes are in preorder, values[i] and sizes[i] are the value and
+        number (0 or 1) of the taxa at node i.
+        """
+        fps, sizes = list(values), list(sizes)
+        for i in range(len(parent) - 1, 0, -1):
+            fps[parent[i]] ^= fps[i]
+            sizes[parent[i]] += sizes[i]
+        total, n_taxa = fps[0], sizes[0]
+
+        out = set()
+        for fp, size in zip(fps, sizes):
+            if 2 <= size <= n_taxa - 2:
+                if fp ^ total < fp:
+                    fp, size = fp ^ total, n_taxa - size
+                out.add((fp >> 64, fp & 0xFFFFFFFFFFFFFFFF, size))
+        return np.array(sorted(out), dtype=np.uint64).reshape(-1, 3)
+
+    @staticmethod
+    def encode_tree(tree: ParsedTree, taxa_idx):
+        """Return the taxon of each node (-1 if none), and the splits of a parsed tree."""
+        label_taxa = np.array([taxa_idx.get(x, -1) for x in tree.labels] + [-1], dtype=np.int32)
+        taxon = label_taxa[tree.leaf]
+        parent = np.array(tree.parent, dtype=np.int32)
+        values = [0 if x < 0 else _taxon_value(tree.labels[y]) for x, y in zip(taxon.tolist(), tree.leaf.tolist())]
+        keys = SplitFingerprints.fingerprints(parent.tolist(), values, (taxon >= 0).tolist())
+        return (parent, taxon), keys
+
+    @staticmethod
+    def encode(path, taxa_idx):
+        """Read a Newick tree and return its structure and splits."""
+        return SplitFingerprints.encode_tree(ParsedTree.from_newick(path), taxa_idx)
+
+    @staticmethod
+    def encode_parsed(path, taxa_idx):
+        """As SplitFingerprints.encode, but for a tree written by ParsedTree.write."""
+        return SplitFingerprints.encode_tree(ParsedTree.load(path), taxa_idx)
+
+    def add(self, tree_id, tree, keys):
+        """Store the structure and encoded splits of a tree, see SplitFingerprints.encode."""
+        self.check(keys, tree_id)
+        self.trees[tree_id] = tree
+        self.splits[tree_id] = keys
+
+    def check(self, keys, desc):
+        """Raise an exception if the same fingerprint is found with two sizes (a collision)."""
+        fps = np.unique(keys[:, 0:2], axis=0)
+        if len(fps) != len(keys):
+            raise MetaTreeExit(f'A split fingerprint collision was detected ({desc}), '
+                               f'use a different Robinson-Foulds method.')
+
+    def leaves(self, tree_id):
+        taxon = self.trees[tree_id][1]
+        return np.sort(taxon[taxon >= 0])
+
+    def robinson_foulds(self, tid_a, tid_b):
+        """Calculate the Robinson-Foulds distance between two encoded trees,
+        pruning both to their common taxa if required."""
+        keys_a, keys_b = self.splits[tid_a], self.splits[tid_b]
+        leaves = self.leaves(tid_a)
+        leaves_b = self.leaves(tid_b)
+        if not np.array_equal(leaves, leaves_b):
+            leaves = np.intersect1d(leaves, leaves_b, assume_unique=True)
+            if len(leaves) == 0:
+                raise MetaTreeExit(f'No taxa in common between {tid_a} and {tid_b}.')
+            keys_a, keys_b = [self.prune(x, leaves) for x in (tid_a, tid_b)]
+
+        num_taxa = len(leaves)
+        check_rf_taxa(num_taxa, f'common between {tid_a} and {tid_b}')
+
+        # Splits are unique within a tree, so those in both appear twice.
+        keys = np.concatenate((keys_a, keys_b))
+        self.check(np.unique(keys, axis=0), f'{tid_a} and {tid_b}')
+        n_shared = len(keys) - len(np.unique(keys, axis=0))
+        rf = len(keys) - 2 * n_shared
+        normalized_rf = float(rf) / (2 * (num_taxa - 3))
+
+        return rf, normalized_rf
+
+    def prune(self, tree_id, leaves):
+        """Return the splits of an encoded tree restricted to the taxa in leaves."""
+        parent, taxon = self.trees[tree_id]
+        keep = np.isin(taxon, leaves)
+        values = [_taxon_value(self.taxa[x]) if k else 0 for x, k in zip(taxon.tolist(), keep.tolist())]
+        return SplitFingerprints.fingerprints(parent.tolist(), values, keep.tolist())
+
+    def rf_matrix(self, tree_ids):
+        """Calculate the Robinson-Foulds distance between all encoded trees,
+        as TreeSplits.rf_matrix."""
+        leaves = [self.leaves(x) for x in tree_ids]
+        n_taxa = [len(x) for x in leaves]
+        for tree_id, n in zip(tree_ids, n_taxa):
+            check_rf_taxa(n, f'tree {tree_id}')
+
+        keys, inverse = np.unique(np.concatenate([self.splits[x] for x in tree_ids]), axis=0,
+                                  return_inverse=True)
+        self.check(keys, 'all trees')
+        rows = np.repeat(np.arange(len(tree_ids)), [len(self.splits[x]) for x in tree_ids])
+        incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, inverse.reshape(-1))),
+                                      shape=(len(tree_ids), len(keys)))
+
+        shared = (incidence @ incidence.T).toarray()
+        n_splits = np.diag(shared)
+        rf = n_splits[:, None] + n_splits[None, :] - 2 * shared
+
+        norm_rf = rf / (2 * (np.array(n_taxa, dtype=np.float64)[:, None] - 3))
+        np.fill_diagonal(norm_rf, 0.0)
+
+        # Pairs of trees over a different set of taxa need to be pruned.
+        for i in range(len(tree_ids)):
+            for j in range(i):
+                if not np.array_equal(leaves[i], leaves[j]):
+                    rf[i, j], norm_rf[i, j] = self.robinson_foulds(tree_ids[i], tree_ids[j])
+                    rf[j, i], norm_rf[j, i] = rf[i, j], norm_rf[i, j]
+
+        return rf, norm_rf
@@ -0,0 +1,49 @@
+import random
+
+import dendropy
+from dendropy.calculate import treecompare
+
+
+def random_newick(labels, seed, polytomies=0.0):
+    """Return a random unrooted Newick tree with branch lengths and support values.
+
+    Each internal node is collapsed into its parent with probability polytomies.
+    """
+    rng = random.Random(seed)
+    nodes = [f'{x}:{rng.uniform(0.01, 1):.4f}' for x in labels]
+    rng.shuffle(nodes)
+    while len(nodes) > 3:
+        a, b = nodes.pop(rng.randrange(len(nodes))), nodes.pop(rng.randrange(len(nodes)))
+        if rng.random() < polytomies and len(nodes) > 1:
+            c = nodes.pop(rng.randrange(len(nodes)))
+            nodes.append(f'({a},{b},{c}){rng.randint(0, 100)}:{rng.uniform(0.01, 1):.4f}')
+        else:
+            nodes.append(f'({a},{b}){rng.randint(0, 100)}:{rng.uniform(0.01, 1):.4f}')
+    return f'({",".join(nodes)});\n'
+
+
+def write_trees(directory, newicks):
+    """Write each Newick tree to directory, returns the path of each."""
+    paths = list()
+    for i, newick in enumerate(newicks):
+        path = f'{directory}/tree_{i}.tree'
+        with open(path, 'w') as fh:
+            fh.write(newick)
+        paths.append(path)
+    return paths
+
+
+def dendropy_rf(path_a, path_b, taxa=None):
+    """The unrooted Robinson-Foulds distance between two trees and its normalised
+    value, as calculated by dendropy over the taxa the trees have in common (and taxa, if given)."""
+    tns = dendropy.TaxonNamespace()
+    trees = [dendropy.Tree.get_from_path(x, schema='newick', rooting='force-unrooted', preserve_underscores=True,
+                                         taxon_namespace=tns) for x in (path_a, path_b)]
+    common = set.intersection(*[{x.taxon.label for x in t.leaf_node_iter()} for t in trees])
+    if taxa is not None:
+        common &= set(taxa)
+    for tree in trees:
+        tree.retain_taxa_with_labels(common)
+    rf = treecompare.symmetric_difference(*trees)
+    n_taxa = len(trees[0].leaf_nodes())
+    return rf, rf / (2 * (n_taxa - 3))
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+
+from metatree.cache import ArtifactCache
+
+
+class TestArtifactCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path_input = self.path('input.tree')
+        self.write(self.path_input, '(A,B,(C,D));\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, *parts):
+        return os.path.join(self.tmp.name, *parts)
+
+    @staticmethod
+    def write(path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fh:
+            fh.write(content)
+
+    @staticmethod
+    def read(path):
+        with open(path) as fh:
+            return fh.read()
+
+    def key(self, cache, *params):
+        return ArtifactCache.make_key(cache.hash_file(self.path_input), *params)
+
+    def create(self, cache, outputs, key, content):
+        """Create the outputs unless they are cached, returns True if they were cached."""
+        if cache.fetch(key, outputs):
+            return True
+        for path in outputs:
+            self.write(path, content)
+        cache.store(key, outputs)
+        return False
+
+    def test_output_stamp(self):
+        cache = ArtifactCache()
+        outputs = [self.path('out', 'rooted.tree'), self.path('out', 'rooted.tree-taxonomy')]
+        key = self.key(cache, 'p__A')
+        self.assertFalse(self.create(cache, outputs, key, 'first'))
+        self.assertTrue(self.create(cache, outputs, key, 'second'))
+        self.assertEqual(self.read(outputs[0]), 'first')
+
+        # Changing a parameter, or the input, is a miss.
+        self.assertFalse(self.create(cache, outputs, self.key(cache, 'p__B'), 'third'))
+        self.assertEqual(self.read(outputs[0]), 'third')
+        self.write(self.path_input, '(A,C,(B,D));\n')
+        self.assertFalse(self.create(ArtifactCache(), outputs, self.key(ArtifactCache(), 'p__B'), 'fourth'))
+        self.assertEqual(self.read(outputs[1]), 'fourth')
+
+    def test_missing_output(self):
+        cache = ArtifactCache()
+        outputs = [self.path('out', 'a'), self.path('out', 'b')]
+        key = self.key(cache)
+        self.create(cache, outputs, key, 'first')
+        os.remove(outputs[1])
+        self.assertFalse(self.create(cache, outputs, key, 'second'))
+
+    def test_shared_cache(self):
+        cache = ArtifactCache(self.path('cache'))
+        key = self.key(cache, 'p__A')
+        self.assertFalse(self.create(cache, [self.path('run1', 'a'), self.path('run1', 'b')], key, 'first'))
+
+        # A different run is restored from the cache directory.
+        outputs = [self.path('run2', 'a'), self.path('run2', 'b')]
+        self.assertTrue(self.create(ArtifactCache(self.path('cache')), outputs, key, 'second'))
+        self.assertEqual([self.read(x) for x in outputs], ['first', 'first'])
+
+        # But not once the input has changed.
+        self.write(self.path_input, '(A,C,(B,D));\n')
+        cache = ArtifactCache(self.path('cache'))
+        self.assertFalse(self.create(cache, outputs, self.key(cache, 'p__A'), 'third'))
+        self.assertEqual(self.read(outputs[0]), 'third')
+
+    def test_evict(self):
+        cache = ArtifactCache(self.path('cache'))
+        keys = [ArtifactCache.make_key(i) for i in range(3)]
+        for i, key in enumerate(keys):
+            self.create(cache, [self.path('out', str(i))], key, '0123456')
+            os.utime(cache._entry(key), (i, i))
+
+        # The least recently used entries are removed first.
+        cache.max_bytes = 10
+        cache.evict()
+        self.assertEqual([os.path.isdir(cache._entry(x)) for x in keys], [False, False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
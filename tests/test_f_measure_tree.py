@@ -0,0 +1,70 @@
+import io
+import json
+import sys
+import unittest
+
+from metatree.f_measure_tree import TaxonTree
+
+
+class TestTaxonTree(unittest.TestCase):
+
+    @staticmethod
+    def make_tree():
+        tree = TaxonTree('d__Bacteria')
+        genus = tree.add_ranks(['p__A', 'c__B', 'o__C', 'f__D', 'g__E'])
+        tree.add_ranks(['p__A', "c__F G's"])
+        tree.add_expected_count(genus, 3)
+        tree.add_metadata(genus, {'f_measure': 0.5})
+        return tree, genus
+
+    def test_write_newick(self):
+        tree, _ = self.make_tree()
+        out = io.StringIO()
+        tree.write_newick(out)
+        self.assertEqual(out.getvalue(), "((((('g__E')'f__D')'o__C')'c__B','c__F G''s')'p__A')'d__Bacteria';\n")
+
+    def test_write_json(self):
+        tree, genus = self.make_tree()
+        out = io.StringIO()
+        tree.write_json(out)
+        data = json.loads(out.getvalue())
+        self.assertEqual(data['name'], 'd__Bacteria')
+        self.assertIsNone(data['parent'])
+        phylum = data['children'][0]
+        self.assertEqual([x['name'] for x in phylum['children']], ['c__B', "c__F G's"])
+        node = phylum['children'][0]
+        while node['name'] != 'g__E':
+            node = node['children'][0]
+        self.assertEqual(node, {'name': 'g__E', 'parent': 'f__D', 'n_expected': 3,
+                                'metadata': [{'f_measure': 0.5}]})
+
+    def test_deep_tree(self):
+        """The depth of the tree is not limited by the recursion limit."""
+        depth = 5 * sys.getrecursionlimit()
+        tree = TaxonTree('root')
+        tree.add_ranks([f'n{i}' for i in range(depth)])
+
+        out = io.StringIO()
+        tree.write_newick(out)
+        newick = out.getvalue()
+        self.assertEqual(newick.count('('), depth)
+        self.assertTrue(newick.startswith('(' * depth + f'n{depth - 1})n{depth - 2})'))
+
+        out = io.StringIO()
+        tree.write_json(out)
+        content = out.getvalue()
+        self.assertEqual(content.count('"children": ['), depth)
+        self.assertTrue(content.endswith(f'{{"name": "n{depth - 1}", "parent": "n{depth - 2}"}}' + ']}' * depth))
+        limit = sys.getrecursionlimit()
+        try:
+            sys.setrecursionlimit(4 * depth)
+            node = json.loads(content)
+        finally:
+            sys.setrecursionlimit(limit)
+        for _ in range(depth):
+            node = node['children'][0]
+        self.assertEqual(node['name'], f'n{depth - 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+from metatree.io.taxonomy_file import TaxonomyFile
+from metatree.mismatch_table import MismatchTable, RANKS, STATUS, compare_tax, read_model_taxonomy
+
+TRUTH = {
+    'G1': 'd__A;p__B;c__C;o__D;f__E;g__F;s__F x',
+    'G2': 'd__A;p__B;c__C;o__D;f__E;g__F;s__F y',
+    'G3': 'd__A;p__B;c__C;o__D;f__E;g__G;s__G z',
+    'G4': 'd__A;p__H;c__I;o__J;f__K;g__L;s__L w',
+    'G5': 'd__A;p__H;c__I;o__J;f__K;g__L;s__L v',
+}
+
+MODEL = {
+    'G1': ('d__A; p__B; c__C; o__D; f__E; g__F; s__F x', 'agree', ''),
+    'G2': ('d__A; p__B; c__C; o__D; f__E; g__G; s__F y', 'disagree', 'g'),
+    'G3': ('d__A; p__B; c__C; o__D; f__E; g__G', 'polyphyletic', 's'),
+    'G4': ('d__A; p__H; c__I; o__Novel; f__K; g__L; s__L w', 'disagree', 'o'),
+    'G5': ('d__A; p__H; p__B; c__I; o__J; f__K; g__L; s__L v', 'polyphyletic', 'p'),
+    'G6': ('d__A; p__B; c__C; o__D; f__E; g__F; s__F x', 'not_in_taxonomy', ''),
+}
+
+
+class TestMismatchTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path_truth = self.write('taxonomy.tsv', TRUTH)
+        self.path_model = self.write('T0_rooted_decorated.tree-taxonomy', {k: v[0] for k, v in MODEL.items()})
+        self.truth = TaxonomyFile(self.path_truth)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, taxonomy):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as fh:
+            fh.write(''.join(f'{k}\t{v}\n' for k, v in taxonomy.items()))
+        return path
+
+    def test_compare_tax(self):
+        gids, taxonomies, model = read_model_taxonomy(self.path_model, self.truth)
+        self.assertEqual(gids, list(MODEL))
+        self.assertEqual(taxonomies, [x[0] for x in MODEL.values()])
+
+        status, first = compare_tax(self.truth, gids, model)
+        self.assertEqual([STATUS[x] for x in status], [x[1] for x in MODEL.values()])
+        self.assertEqual([RANKS[x] if x >= 0 else '' for x in first], [x[2] for x in MODEL.values()])
+
+    def test_compare_tax_index(self):
+        """The memory-mapped taxonomy gives the same result."""
+        path_index = os.path.join(self.tmp.name, 'taxonomy.idx')
+        TaxonomyFile(self.path_truth, path_index)
+        truth = TaxonomyFile(self.path_truth, path_index)
+        gids, _, model = read_model_taxonomy(self.path_model, truth)
+        status, _ = compare_tax(truth, gids, model)
+        self.assertEqual([STATUS[x] for x in status], [x[1] for x in MODEL.values()])
+
+    def test_write(self):
+        mmt = MismatchTable(os.path.join(self.tmp.name, 'model_taxonomy_diff.tsv'))
+        MismatchTable.worker_init(self.truth)
+        mmt.add(MismatchTable.worker('T0', self.path_model))
+        mmt.write(['T0'])
+
+        with open(mmt.path) as fh:
+            self.assertEqual(fh.read().split('\n')[1], 'T0\t1\t2\t2\t1')
+        with open(mmt.path_genomes) as fh:
+            lines = fh.read().rstrip('\n').split('\n')
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1].split('\t'), ['T0', 'G2', 'disagree', 'g', TRUTH['G2'], MODEL['G2'][0]])
+        self.assertEqual(lines[5].split('\t'), ['T0', 'G6', 'not_in_taxonomy', '', '', MODEL['G6'][0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import io
+import unittest
+
+import numpy as np
+from Bio import Phylo
+from Bio.Phylo.TreeConstruction import DistanceMatrix, DistanceTreeConstructor
+
+from metatree.neighbour_joining import neighbour_joining
+
+
+class TestNeighbourJoining(unittest.TestCase):
+    """The tree is identical to BioPython's, including the join order of ties."""
+
+    @staticmethod
+    def biopython_nj(labels, mat):
+        dm = DistanceMatrix(labels, [[float(mat[i, j]) for j in range(i + 1)] for i in range(len(labels))])
+        return DistanceTreeConstructor().nj(dm)
+
+    @staticmethod
+    def to_newick(tree):
+        buf = io.StringIO()
+        Phylo.write(tree, buf, 'newick')
+        return buf.getvalue()
+
+    def assertSameTree(self, mat):
+        labels = [f'T{i}' for i in range(len(mat))]
+        self.assertEqual(self.to_newick(neighbour_joining(labels, mat)),
+                         self.to_newick(self.biopython_nj(labels, mat)))
+
+    @staticmethod
+    def symmetric(values):
+        mat = np.tril(values, -1)
+        return mat + mat.T
+
+    def test_random(self):
+        rng = np.random.default_rng(0)
+        for n in (3, 4, 5, 10, 25):
+            with self.subTest(n=n):
+                self.assertSameTree(self.symmetric(rng.random((n, n))))
+
+    def test_ties(self):
+        rng = np.random.default_rng(1)
+        for n in (4, 6, 12):
+            with self.subTest(n=n):
+                self.assertSameTree(self.symmetric(rng.integers(0, 3, (n, n)).astype(float)))
+
+    def test_all_equal(self):
+        self.assertSameTree(self.symmetric(np.ones((8, 8))))
+
+    def test_small(self):
+        for n in (1, 2):
+            with self.subTest(n=n):
+                self.assertSameTree(self.symmetric(np.full((n, n), 0.5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
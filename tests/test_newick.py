@@ -0,0 +1,58 @@
+import io
+import os
+import tempfile
+import unittest
+
+import dendropy
+
+from metatree.io.newick import iter_tokens, read_leaf_labels
+from tests.helpers import random_newick
+
+
+class TestNewick(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, newick):
+        path = os.path.join(self.tmp.name, 'input.tree')
+        with open(path, 'w') as fh:
+            fh.write(newick)
+        return path
+
+    @staticmethod
+    def dendropy_labels(path):
+        tree = dendropy.Tree.get_from_path(path, schema='newick', preserve_underscores=True)
+        return [x.taxon.label for x in tree.leaf_node_iter()]
+
+    def assertSameLabels(self, newick):
+        path = self.write(newick)
+        self.assertEqual(read_leaf_labels(path), self.dendropy_labels(path))
+
+    def test_random_tree(self):
+        self.assertSameLabels(random_newick([f'GB_GCA_{i:09d}.1' for i in range(200)], 0, 0.3))
+
+    def test_quoted_labels(self):
+        self.assertSameLabels("(('A B':1,'C,(D)':0.5)'80:g__X; s__Y':1,'it''s':2,E_F:3);")
+
+    def test_comments_and_whitespace(self):
+        self.assertSameLabels("[&R] (A[c1]:1 ,\n (B : 2, C:3)[&support=90] 90 : 1,\tD);\n")
+
+    def test_tokens_span_chunks(self):
+        newick = "(('quoted label':1.25,[a, comment]long_label_abcdefghij:2)90:1,C);"
+        expected = list(iter_tokens(io.StringIO(newick)))
+        for chunk_size in range(1, 8):
+            self.assertEqual(list(iter_tokens(io.StringIO(newick), chunk_size=chunk_size)), expected)
+        self.assertIn("'quoted label'", expected)
+        self.assertNotIn('[a, comment]', expected)
+
+    def test_unterminated_comment(self):
+        with self.assertRaises(ValueError):
+            list(iter_tokens(io.StringIO('(A,B,[C);')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+import dendropy
+
+from metatree.exception import MetaTreeExit
+from metatree.external.reroot_tree import RerootTree
+
+
+class TestRerootTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path_out = os.path.join(self.tmp.name, 'rooted.tree')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def root(self, newick, outgroup):
+        path_in = os.path.join(self.tmp.name, 'input.tree')
+        with open(path_in, 'w') as fh:
+            fh.write(newick)
+        RerootTree().root_with_outgroup(path_in, self.path_out, outgroup)
+        return dendropy.Tree.get_from_path(self.path_out, schema='newick', rooting='force-rooted',
+                                           preserve_underscores=True)
+
+    @staticmethod
+    def root_clades(tree):
+        return {frozenset(x.taxon.label for x in child.leaf_iter()) for child in tree.seed_node.child_node_iter()}
+
+    def test_outgroup_clade(self):
+        tree = self.root('((O1:1,O2:1)70:1,A:1,(B:1,C:1)90:1);', ['O1', 'O2'])
+        self.assertEqual(self.root_clades(tree), {frozenset({'O1', 'O2'}), frozenset({'A', 'B', 'C'})})
+
+    def test_outgroup_spans_the_basal_node(self):
+        tree = self.root('(O1:1,(A:1,(B:1,C:1)90:1)80:1,O2:1);', ['O1', 'O2'])
+        self.assertEqual(self.root_clades(tree), {frozenset({'O1', 'O2'}), frozenset({'A', 'B', 'C'})})
+
+        # The root edge is split in half, and its support is kept on both sides.
+        for child in tree.seed_node.child_node_iter():
+            self.assertAlmostEqual(child.edge_length, 0.5)
+            self.assertEqual(child.label, '80.0')
+        clade_bc = tree.find_node_with_taxon_label('B').parent_node
+        self.assertEqual(clade_bc.label, '90.0')
+
+    def test_single_taxon_outgroup(self):
+        tree = self.root('(O1:1,(A:1,(B:1,C:1)90:1)80:1,D:1);', ['O1'])
+        self.assertEqual(self.root_clades(tree), {frozenset({'O1'}), frozenset({'A', 'B', 'C', 'D'})})
+
+    def test_non_monophyletic_outgroup(self):
+        # As in GenomeTreeTk, the tree is rooted at the MRCA of the outgroup.
+        tree = self.root('(B:1,(C:1,D:1)90:1,(O1:1,(O2:1,A:1)60:1)70:1);', ['O1', 'O2'])
+        self.assertEqual(self.root_clades(tree), {frozenset({'O1', 'O2', 'A'}), frozenset({'B', 'C', 'D'})})
+
+    def test_missing_outgroup(self):
+        with self.assertRaises(MetaTreeExit):
+            self.root('(A:1,(B:1,C:1)90:1,D:1);', ['O1'])
+
+    def test_outgroup_is_every_taxon(self):
+        with self.assertRaises(MetaTreeExit):
+            self.root('(A:1,(B:1,C:1)90:1,D:1);', ['A', 'B', 'C', 'D'])
+
+
+if __name__ == '__main__':
+    unittest.main()
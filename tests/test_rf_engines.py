@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+
+from metatree.exception import MetaTreeExit
+from metatree.external.tree_compare import TreeCompare
+from metatree.io.parsed_tree import ParsedTree
+from metatree.tree_metrics import TreeMetrics
+from metatree.tree_splits import SplitFingerprints, TreeSplits
+from tests.helpers import dendropy_rf, random_newick, write_trees
+
+
+class TestRfEngines(unittest.TestCase):
+    """The Robinson-Foulds distance of each engine is the same as dendropy."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        labels = [f'G{i:03d}' for i in range(40)]
+
+        # Trees over the same taxa, and trees over different (overlapping) taxa.
+        cls.same = write_trees(cls.tmp.name, [random_newick(labels, seed, 0.2) for seed in range(5)])
+        os.makedirs(f'{cls.tmp.name}/mixed')
+        cls.mixed = write_trees(f'{cls.tmp.name}/mixed',
+                                [random_newick(labels[i:i + 30], 100 + i, 0.2) for i in range(0, 10, 2)])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    @staticmethod
+    def taxa_of(paths):
+        return [set(ParsedTree.from_newick(x).labels) for x in paths]
+
+    def expected(self, paths, taxa):
+        out = dict()
+        for i in range(len(paths)):
+            for j in range(i):
+                out[(i, j)] = dendropy_rf(paths[i], paths[j], taxa)
+        return out
+
+    def assertResults(self, expected, rf_fn):
+        for (i, j), (rf, norm_rf) in expected.items():
+            value, norm_value = rf_fn(i, j)
+            self.assertEqual(value, rf, (i, j))
+            self.assertAlmostEqual(norm_value, norm_rf, places=12, msg=(i, j))
+
+    def check_splits(self, cls, paths, taxa, parsed):
+        splits = cls(taxa)
+        for i, path in enumerate(paths):
+            if parsed:
+                path_parsed = f'{path}.bin'
+                ParsedTree.from_newick(path).write(path_parsed, path)
+                splits.add(i, *cls.encode_parsed(path_parsed, splits.taxa_idx))
+            else:
+                splits.add(i, *cls.encode(path, splits.taxa_idx))
+        expected = self.expected(paths, taxa)
+
+        # Cached (each pair), and matrix (all pairs in one step).
+        self.assertResults(expected, splits.robinson_foulds)
+        mat_rf, mat_norm_rf = splits.rf_matrix(list(range(len(paths))))
+        self.assertResults(expected, lambda i, j: (int(mat_rf[i, j]), float(mat_norm_rf[i, j])))
+
+    def check_all_modes(self, fn):
+        for paths in (self.same, self.mixed):
+            taxa = self.taxa_of(paths)
+            for mode_taxa in (set.union(*taxa), set.intersection(*taxa)):
+                with self.subTest(paths=os.path.dirname(paths[0]), n_taxa=len(mode_taxa)):
+                    fn(paths, mode_taxa)
+
+    def test_tree_splits(self):
+        self.check_all_modes(lambda paths, taxa: self.check_splits(TreeSplits, paths, taxa, False))
+
+    def test_tree_splits_parsed(self):
+        self.check_all_modes(lambda paths, taxa: self.check_splits(TreeSplits, paths, taxa, True))
+
+    def test_split_fingerprints(self):
+        self.check_all_modes(lambda paths, taxa: self.check_splits(SplitFingerprints, paths, taxa, False))
+
+    def test_split_fingerprints_parsed(self):
+        self.check_all_modes(lambda paths, taxa: self.check_splits(SplitFingerprints, paths, taxa, True))
+
+    def test_tree_metrics(self):
+        def check(paths, taxa):
+            metrics = TreeMetrics(taxa, ('rf',))
+            for i, path in enumerate(paths):
+                metrics.add(i, *TreeMetrics.encode(path, metrics.taxa_idx, 50.0, 1.0, parsed=False))
+            expected = self.expected(paths, taxa)
+            self.assertResults(expected, lambda i, j: metrics.compare(i, j)['rf'])
+
+        self.check_all_modes(check)
+
+    def test_too_few_taxa(self):
+        """Every engine stops if the normalised distance is undefined (3 or fewer taxa)."""
+        os.makedirs(f'{self.tmp.name}/small')
+        for name, newicks in (('same', ['(A,B,C);', '(A,C,B);']),
+                              ('pruned', ['(A,B,(C,D));', '(A,B,(C,E));'])):
+            paths = write_trees(f'{self.tmp.name}/small', newicks)
+            taxa = set.union(*self.taxa_of(paths))
+            with self.subTest(name=name):
+                with self.assertRaises(MetaTreeExit):
+                    TreeCompare().robinson_foulds(paths[0], paths[1], None)
+                for cls in (TreeSplits, SplitFingerprints):
+                    splits = cls(taxa)
+                    for i, path in enumerate(paths):
+                        splits.add(i, *cls.encode(path, splits.taxa_idx))
+                    with self.assertRaises(MetaTreeExit):
+                        splits.robinson_foulds(1, 0)
+                    with self.assertRaises(MetaTreeExit):
+                        splits.rf_matrix([0, 1])
+                metrics = TreeMetrics(taxa, ('rf',))
+                for i, path in enumerate(paths):
+                    metrics.add(i, *TreeMetrics.encode(path, metrics.taxa_idx, 50.0, 1.0, parsed=False))
+                with self.assertRaises(MetaTreeExit):
+                    metrics.compare(1, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
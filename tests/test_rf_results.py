@@ -0,0 +1,99 @@
+import os
+import tempfile
+import unittest
+
+from metatree.cache import ArtifactCache
+from metatree.io import Batchfile, RfResults
+from metatree.tree_dist import TreeDist
+from tests.helpers import dendropy_rf, random_newick, write_trees
+
+
+class TestRfResults(unittest.TestCase):
+    """Existing results are only re-used for pairs of trees which are unchanged."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.labels = [f'G{i:03d}' for i in range(20)]
+        self.paths = write_trees(self.tmp.name, [random_newick(self.labels, i) for i in range(4)])
+        self.path_batchfile = os.path.join(self.tmp.name, 'batchfile.tsv')
+        with open(self.path_batchfile, 'w') as fh:
+            fh.write(''.join(f'T{i}\t{x}\n' for i, x in enumerate(self.paths)))
+        self.path_results = os.path.join(self.tmp.name, 'results', 'rf_all_taxa.tsv')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_rf(self, method='pairwise'):
+        """Validate the existing results, and calculate those which are missing."""
+        batchfile = Batchfile(self.path_batchfile)
+        rf_results = RfResults(self.path_results)
+        rf_results.validate({k: ArtifactCache().hash_file(v) for k, v in batchfile.data.items()})
+        queued = {(x[0], x[2]) for x in TreeDist.queue(rf_results, batchfile, False)}
+        TreeDist().run(rf_results, batchfile, self.tmp.name, None, 1, False, method)
+        return queued, RfResults(self.path_results).data
+
+    def expected(self):
+        return {(f'T{i}', f'T{j}'): dendropy_rf(self.paths[i], self.paths[j])
+                for i in range(len(self.paths)) for j in range(i)}
+
+    def assertResults(self, data):
+        expected = self.expected()
+        self.assertEqual(set(data), set(expected))
+        for key, (rf, norm_rf) in expected.items():
+            self.assertEqual(data[key][0], rf, key)
+            self.assertAlmostEqual(data[key][1], norm_rf, places=12, msg=key)
+
+    def test_changed_tree(self):
+        queued, data = self.run_rf()
+        self.assertEqual(len(queued), 6)
+        self.assertResults(data)
+
+        # Nothing is re-calculated if the trees are unchanged.
+        queued, data = self.run_rf()
+        self.assertEqual(queued, set())
+        self.assertResults(data)
+
+        # Only the pairs with the changed tree are re-calculated.
+        for seed, method in enumerate(('pairwise', 'cached', 'matrix')):
+            with self.subTest(method=method):
+                with open(self.paths[2], 'w') as fh:
+                    fh.write(random_newick(self.labels, 100 + seed))
+                queued, data = self.run_rf(method)
+                self.assertEqual(queued, {('T2', 'T0'), ('T2', 'T1'), ('T3', 'T2')})
+                self.assertResults(data)
+
+    def test_removed_tree(self):
+        self.run_rf()
+        with open(self.path_batchfile, 'w') as fh:
+            fh.write(''.join(f'T{i}\t{x}\n' for i, x in enumerate(self.paths[0:3])))
+        self.paths = self.paths[0:3]
+        queued, data = self.run_rf()
+        self.assertEqual(queued, set())
+        self.assertResults(data)
+
+    def test_changed_taxa(self):
+        rf_results = RfResults(self.path_results)
+        rf_results.validate({'T0': 'a', 'T1': 'b'}, self.labels)
+        rf_results.add('T1', 'T0', 4, 0.5)
+        rf_results.close()
+
+        rf_results = RfResults(self.path_results)
+        rf_results.validate({'T0': 'a', 'T1': 'b'}, reversed(self.labels))
+        self.assertTrue(rf_results.is_done('T0', 'T1'))
+        rf_results.validate({'T0': 'a', 'T1': 'b'}, self.labels[1:])
+        self.assertFalse(rf_results.is_done('T0', 'T1'))
+
+    def test_truncated_and_duplicate_lines(self):
+        os.makedirs(os.path.dirname(self.path_results))
+        with open(self.path_results, 'w') as fh:
+            fh.write('T1\tT0\t4\t0.5\nT2\tT0\t6\t0.75\nT0\tT1\t2\t0.25\nT2\tT1\t8')
+        rf_results = RfResults(self.path_results)
+        self.assertEqual(rf_results.data, {('T1', 'T0'): (2, 0.25), ('T2', 'T0'): (6, 0.75)})
+
+        # The file is compacted to one line per pair.
+        with open(self.path_results) as fh:
+            self.assertEqual(fh.read(), 'T1\tT0\t2\t0.25\nT2\tT0\t6\t0.75\n')
+
+
+if __name__ == '__main__':
+    unittest.main()